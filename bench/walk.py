@@ -0,0 +1,168 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the legacy os.walk-based listing of a local tree with the scandir
+# walker used by LocalFS. Hashing is excluded, as it is the same for both and
+# it is skipped anyway on hash cache hits. The tree is created on the first run
+# and reused afterwards. If strace is available, the number of stat-family
+# system calls made by each walker is reported too.
+#
+# Usage: python -m bench.walk [-n ENTRIES] [--fanout N] [--root PATH]
+
+from argparse import ArgumentParser
+from datetime import datetime
+import os
+import shutil
+import subprocess
+import sys
+from tempfile import gettempdir
+from time import perf_counter
+
+from erwin.fs.local import LocalFile, _walk
+
+
+def make_tree(root, entries, fanout):
+    marker = os.path.join(root, ".complete")
+    if os.path.isfile(marker):
+        return
+
+    shutil.rmtree(root, ignore_errors=True)
+
+    created = 0
+    folders = [root]
+    os.makedirs(root)
+    while created < entries:
+        parent = folders.pop(0)
+        for i in range(fanout):
+            if created >= entries:
+                break
+            path = os.path.join(parent, f"d{i}")
+            os.mkdir(path)
+            folders.append(path)
+            created += 1
+            for j in range(fanout):
+                if created >= entries:
+                    break
+                open(os.path.join(path, f"f{j}"), "w").close()
+                created += 1
+
+    open(marker, "w").close()
+
+
+def legacy_walk(root):
+    files = []
+    for dp, dn, filenames in os.walk(root):
+        for f in dn + filenames:
+            abs_path = os.path.join(dp, f)
+            is_folder = os.path.isdir(abs_path)
+            files.append(
+                LocalFile(
+                    md5=os.stat(abs_path).st_ino if is_folder else None,
+                    is_folder=is_folder,
+                    modified_date=datetime.fromtimestamp(
+                        round(os.path.getmtime(abs_path), 3)
+                    )
+                    if not is_folder
+                    else None,
+                )
+            )
+    return files
+
+
+def scandir_walk(root):
+    return [LocalFile.from_stat(stat) for _, stat in _walk(root)]
+
+
+WALKERS = {"legacy": legacy_walk, "scandir": scandir_walk}
+
+
+def run(walker, root):
+    start = perf_counter()
+    n = len(WALKERS[walker](root))
+    return n, perf_counter() - start
+
+
+def count_syscalls(walker, root):
+    output = subprocess.run(
+        [
+            "strace",
+            "-f",
+            "-c",
+            "-e",
+            "trace=stat,lstat,fstat,newfstatat,statx,getdents64",
+            sys.executable,
+            "-m",
+            "bench.walk",
+            "--root",
+            root,
+            "--only",
+            walker,
+        ],
+        stderr=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        universal_newlines=True,
+    ).stderr
+
+    calls = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if fields and fields[-1] in ("stat", "lstat", "fstat", "newfstatat", "statx"):
+            calls["stat"] = calls.get("stat", 0) + int(fields[3])
+        elif fields and fields[-1] == "getdents64":
+            calls["getdents64"] = int(fields[3])
+    return calls
+
+
+def main():
+    parser = ArgumentParser(description="Local tree walk benchmark")
+    parser.add_argument("-n", "--entries", type=int, default=1_000_000)
+    parser.add_argument("--fanout", type=int, default=100)
+    parser.add_argument("--root", default=None)
+    parser.add_argument("--only", choices=list(WALKERS), default=None)
+    args = parser.parse_args()
+
+    root = args.root or os.path.join(gettempdir(), f"erwin-bench-{args.entries}")
+
+    if args.only:
+        run(args.only, root)
+        return
+
+    print(f"Preparing tree with {args.entries} entries at {root}")
+    make_tree(root, args.entries, args.fanout)
+
+    for walker in WALKERS:
+        n, elapsed = run(walker, root)
+        print(f"{walker:8} {n} entries in {elapsed:.3f} s")
+
+    if shutil.which("strace"):
+        for walker in WALKERS:
+            calls = count_syscalls(walker, root)
+            print(
+                f"{walker:8} {calls.get('stat', 0)} stat calls, "
+                f"{calls.get('getdents64', 0)} getdents64 calls"
+            )
+    else:
+        print("strace not found: skipping system call count")
+
+
+if __name__ == "__main__":
+    main()
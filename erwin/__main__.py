@@ -39,6 +39,8 @@ class Erwin:
         self.master_fs = None
         self.slave_fs = None
         self._queue = Queue()  # Queue of collected deltas
+        self._workers = 1  # Number of parallel transfers
+        self._timeout = None  # Seconds to wait for changes to be applied
 
     def resolve_conflicts(self, master_deltas, slave_deltas):
         mc, sc = master_deltas & slave_deltas
@@ -114,7 +116,7 @@ class Erwin:
         while True:
             LOGGER.info("Watching for FS state changes")
             delta, source, dest = self._queue.get()
-            delta.apply(source, dest)
+            delta.apply(source, dest, self._workers, self._timeout)
             LOGGER.debug(f"Incremental delta applied to {dest[0]}")
 
         for watch in watches:
@@ -125,12 +127,18 @@ class Erwin:
         with ErwinConfiguration() as config:
             LOGGER.info("Erwin configuration loaded successfully.")
 
+            ignore = config.get_ignore_rules()
+            self._workers = config.get_transfer_workers()
+            self._timeout = config.get_wait_timeout()
+
             # Create master and slave FSs
-            self.master_fs = GoogleDriveFS(**config.get_master_fs_params())
+            self.master_fs = GoogleDriveFS(
+                ignore=ignore, **config.get_master_fs_params()
+            )
             LOGGER.info("Master FS is online.")
             LOGGER.debug(f"Created Master FS of type {type(self.master_fs)}")
 
-            self.slave_fs = LocalFS(**config.get_slave_fs_params())
+            self.slave_fs = LocalFS(ignore=ignore, **config.get_slave_fs_params())
             LOGGER.info("Slave FS is online.")
             LOGGER.debug(f"Created Slave FS of type {type(self.slave_fs)}")
 
@@ -138,7 +146,12 @@ class Erwin:
             prev_master_state, prev_slave_state = config.load_fs_states()
 
             # Register signal handlers
-            config.register_state_handler(prev_master_state, prev_slave_state)
+            config.register_state_handler(
+                prev_master_state,
+                prev_slave_state,
+                self.slave_fs.hash_cache,
+                self.master_fs,
+            )
 
             LOGGER.info("Previous FS states loaded successfully.")
 
@@ -152,7 +165,10 @@ class Erwin:
             self.resolve_conflicts(master_deltas, slave_deltas)
 
             master_deltas.apply(
-                (self.master_fs, prev_master_state), (self.slave_fs, prev_slave_state)
+                (self.master_fs, prev_master_state),
+                (self.slave_fs, prev_slave_state),
+                self._workers,
+                self._timeout,
             )
             if self.master_fs.state - prev_master_state:
                 raise RuntimeError("Not all deltas applied correctly to master!")
@@ -163,7 +179,10 @@ class Erwin:
             LOGGER.debug(f"New deltas:\n{new_slave_deltas}")
 
             new_slave_deltas.apply(
-                (self.slave_fs, prev_slave_state), (self.master_fs, prev_master_state)
+                (self.slave_fs, prev_slave_state),
+                (self.master_fs, prev_master_state),
+                self._workers,
+                self._timeout,
             )
 
             # Start the collectors to watch for changes on both FSs.
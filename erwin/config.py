@@ -28,6 +28,7 @@ import yaml
 
 from erwin import APP_NAME
 from erwin.fs import FSNotReady, State
+from erwin.fs.ignore import IGNORE_FILE, IgnoreRules
 from erwin.logging import LOGGER
 
 
@@ -47,6 +48,8 @@ class ErwinConfiguration:
         self._slave_state = None
         self._master_state_file = None
         self._slave_state_file = None
+        self._hash_cache = None
+        self._master_fs = None
 
     def __enter__(self):
         try:
@@ -120,6 +123,15 @@ class ErwinConfiguration:
             self._slave_state.save(self._slave_state_file)
             LOGGER.info("Slave FS state saved")
 
+        if self._hash_cache:
+            self._hash_cache.save()
+            LOGGER.info("Slave FS hash cache saved")
+
+        if self._master_fs:
+            self._master_fs.save_snapshot()
+            LOGGER.info("Master FS snapshot saved")
+            LOGGER.info(f"Master FS request metrics: {self._master_fs.metrics}")
+
         if signum:
             exit(signum)
 
@@ -137,21 +149,46 @@ class ErwinConfiguration:
 
         return master_state, slave_state
 
-    def register_state_handler(self, master_state, slave_state):
+    def register_state_handler(
+        self, master_state, slave_state, hash_cache=None, master_fs=None
+    ):
         self._master_state = master_state
         self._slave_state = slave_state
+        self._hash_cache = hash_cache
+        self._master_fs = master_fs
         self._orig_sig_handlers = [
             signal.signal(s, self._save_states) for s in self.SIGNALS
         ]
 
-    def _get_fs_params(self, alias, fs):
+    def _alias(self, alias=None):
         if not alias:
             alias, = self._config.keys()
+        return alias
 
-        return self._config[alias][f"{fs}_fs"]["params"]
+    def _get_fs_params(self, alias, fs):
+        return self._config[self._alias(alias)][f"{fs}_fs"]["params"]
 
     def get_master_fs_params(self, alias=None):
-        return self._get_fs_params(alias, "master")
+        alias = self._alias(alias)
+        params = {
+            "upload_sessions": os.path.join(STATES_DIR, f"{alias}_uploads.pickle"),
+            "snapshot": os.path.join(STATES_DIR, f"{alias}_drive.pickle"),
+        }
+        params.update(self._get_fs_params(alias, "master"))
+        return params
+
+    def get_transfer_workers(self, alias=None):
+        return self._config[self._alias(alias)].get("transfer_workers", 4)
+
+    def get_wait_timeout(self, alias=None):
+        return self._config[self._alias(alias)].get("wait_timeout", 300)
+
+    def get_ignore_rules(self, alias=None):
+        root = os.path.abspath(self.get_slave_fs_params(alias)["root"])
+        return IgnoreRules.from_file(os.path.join(root, IGNORE_FILE))
 
     def get_slave_fs_params(self, alias=None):
-        return self._get_fs_params(alias, "slave")
+        alias = self._alias(alias)
+        params = {"hash_cache": os.path.join(STATES_DIR, f"{alias}_hashes.pickle")}
+        params.update(self._get_fs_params(alias, "slave"))
+        return params
@@ -20,20 +20,80 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from threading import RLock
-from time import sleep
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition, Lock, RLock, get_ident
+from time import monotonic, sleep
 
 from erwin.fs import FSNotReady
 from erwin.logging import LOGGER
 
 
+def _overlap(a, b):
+    # Whether two relative paths are the same, or one is an ancestor of the
+    # other. The empty path is the root, which is an ancestor of any path.
+    return not a or not b or a == b or a.startswith(b + "/") or b.startswith(a + "/")
+
+
+class PathLock:
+    # Re-entrant, hierarchical lock on paths. Holding a path excludes other
+    # threads from the path itself, as well as from all of its ancestors and
+    # descendants, so that e.g. a move or a rmtree of a folder is serialised
+    # with any operation within it, while operations on unrelated subtrees run
+    # concurrently. All the paths needed by an operation must be acquired in
+    # one go to avoid deadlocks.
+
+    def __init__(self):
+        self._cond = Condition()
+        self._held = {}  # path -> [thread ident, count]
+
+    def _conflicts(self, paths, me):
+        return any(
+            owner != me and _overlap(path, held)
+            for path in paths
+            for held, (owner, _) in self._held.items()
+        )
+
+    def acquire(self, *paths):
+        paths = {"" if p in (".", "/") else p.strip("/") for p in paths}
+        me = get_ident()
+        with self._cond:
+            while self._conflicts(paths, me):
+                self._cond.wait()
+
+            for path in paths:
+                self._held.setdefault(path, [me, 0])[1] += 1
+
+        return paths
+
+    def release(self, paths):
+        with self._cond:
+            for path in paths:
+                entry = self._held[path]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._held[path]
+            self._cond.notify_all()
+
+    @contextmanager
+    def hold(self, *paths):
+        held = self.acquire(*paths)
+        try:
+            yield
+        finally:
+            self.release(held)
+
+
 GLOBAL_LOCK = RLock()
+PATH_LOCK = PathLock()
 
 
-def atomic(lock=GLOBAL_LOCK):
+def atomic(lock=GLOBAL_LOCK, paths=None):
+    # With a PathLock, paths maps the arguments of the call to the paths that
+    # the call operates on, and only calls on overlapping paths are serialised.
     def atomic_wrapper(f):
         def func_wrapper(*args, **kwargs):
-            with lock:
+            with lock.hold(*paths(*args, **kwargs)) if paths else lock:
                 return f(*args, **kwargs)
 
         return func_wrapper
@@ -41,6 +101,50 @@ def atomic(lock=GLOBAL_LOCK):
     return atomic_wrapper
 
 
+def bounded_map(executor, f, iterable, window):
+    # Like executor.map, but with at most window calls in flight so that
+    # arbitrarily long iterables can be consumed lazily. Results are yielded
+    # in the same order as the arguments.
+    pending = deque()
+    for item in iterable:
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(f, item))
+
+    while pending:
+        yield pending.popleft().result()
+
+
+class TokenBucket:
+    # Bucket of tokens refilled at a constant rate, up to its capacity. Each
+    # unit of work takes a token. When the bucket is empty, callers reserve
+    # future tokens and sleep until they are due, so that the long-term rate
+    # never exceeds the refill rate and waiting callers are served in order.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+
+        self._tokens = self.capacity
+        self._last = monotonic()
+        self._lock = Lock()
+
+    def acquire(self, tokens=1):
+        # Returns the time spent waiting for the tokens.
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= tokens
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if wait:
+            sleep(wait)
+
+        return wait
+
+
 def backoff(delay=5, ratio=1.618, cap=60):
     def wrapper(f):
         def func_wrapper(*args, **kwargs):
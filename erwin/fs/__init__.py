@@ -22,9 +22,13 @@
 
 from abc import ABC, abstractmethod
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from copy import deepcopy
+import os.path
 import pickle
-from time import sleep
+from threading import Condition, RLock
+from time import monotonic
 
 from erwin.logging import LOGGER
 
@@ -33,34 +37,77 @@ class FSNotReady(Exception):
     pass
 
 
-def wait(source_file, dest_fs, dst):
-    LOGGER.debug("Waiting for destination file.")
+class TransferError(Exception):
+    pass
+
+
+# Seconds after which a warning is logged while waiting for a state change.
+WAIT_WARNING = 60
+
+
+def _wait_for(dest_fs, path, predicate, timeout=None):
+    # Block, without polling, until the file at path in the state of dest_fs
+    # satisfies the predicate, and return it. A warning is logged every
+    # WAIT_WARNING seconds, and TimeoutError is raised after timeout seconds.
+    deadline = monotonic() + timeout if timeout is not None else None
     while True:
-        dest_file = dest_fs.search(dst)
-        if source_file & dest_file:
-            LOGGER.debug(f"Destination file {dst} on {dest_fs} became available.")
-            return dest_file
-        sleep(0.001)
-        LOGGER.trace(f"File mismatch: expected {source_file} but got {dest_file}")
+        interval = WAIT_WARNING
+        if deadline is not None:
+            interval = max(0, min(interval, deadline - monotonic()))
+        try:
+            return dest_fs.state.wait_for(path, predicate, interval)
+        except TimeoutError:
+            if deadline is not None and monotonic() >= deadline:
+                raise
+            LOGGER.warning(f"Still waiting for {path} on {dest_fs}.")
+
+
+def wait(source_file, dest_fs, dst, timeout=None):
+    LOGGER.debug("Waiting for destination file.")
+    dest_file = _wait_for(dest_fs, dst, lambda f: source_file & f, timeout)
+    LOGGER.debug(f"Destination file {dst} on {dest_fs} became available.")
+    return dest_file
 
 
-def wait_dir(dest_fs, dst):
+def wait_dir(dest_fs, dst, timeout=None):
     LOGGER.debug(f"Waiting for destination directory {dst} on {dest_fs}.")
-    while True:
-        dest_file = dest_fs.search(dst)
-        if dest_file:
-            LOGGER.debug(f"Destination directory {dst} on {dest_fs} became available.")
-            return dest_file
-        sleep(0.001)
+    dest_file = _wait_for(dest_fs, dst, bool, timeout)
+    LOGGER.debug(f"Destination directory {dst} on {dest_fs} became available.")
+    return dest_file
 
 
-def wait_removed(dest_fs, path):
+def wait_removed(dest_fs, path, timeout=None):
     LOGGER.debug(f"Waiting for destination file {path} to be removed on {dest_fs}.")
-    while dest_fs.search(path):
-        sleep(0.001)
+    _wait_for(dest_fs, path, lambda f: not f, timeout)
     LOGGER.debug(f"Destination file {path} on {dest_fs} has been removed.")
 
 
+def _not_applied(operation, path, dest_fs, error):
+    reason = "timed out" if isinstance(error, TimeoutError) else error
+    LOGGER.error(
+        f"Cannot {operation} {path} on {dest_fs}. Reason: {reason}. "
+        "It will be synchronised again on the next start."
+    )
+
+
+def _transfer(file, source_fs, dest_fs, path, timeout=None):
+    # Write the file at path on the destination and wait for it to show up in
+    # its state. Content that the destination has already is reused rather
+    # than read from the source. Returns None if the file cannot be read, and
+    # raises TransferError if the transfer fails, e.g. halfway through a
+    # download.
+    try:
+        if not dest_fs.reuse(file, path):
+            stream = source_fs.read(path)
+            if not stream:
+                return None
+            dest_fs.write(stream, path, file.modified_date)
+    except Exception as e:
+        raise TransferError(e) from e
+
+    return wait(file, dest_fs, path, timeout)
+
+
 class File(ABC):
     def __init__(self, md5, is_folder, modified_date):
         self.md5 = md5
@@ -119,94 +166,241 @@ class Delta:
 
         return "\n".join([l for l in [added, moved, removed] if l])
 
-    def apply(self, source, dest):
+    def filter(self, ignore, state=None):
+        # Drop all the ignored paths. Removed paths are matched as folders to
+        # err on the side of not propagating removals. Files moved out of an
+        # ignored location are added, provided the given state knows them, and
+        # files moved into one are removed.
+        if not ignore:
+            return self
+
+        added = [(f, p) for f, p in self.added if not ignore.match(p, f.is_folder)]
+        removed = [p for p in self.removed if not ignore.match(p, True)]
+        moved = []
+
+        for src, dst in self.moved:
+            dst_file = state[dst] if state else None
+            src_ignored = ignore.match(src, True)
+            dst_ignored = ignore.match(dst, dst_file.is_folder if dst_file else True)
+            if not (src_ignored or dst_ignored):
+                moved.append((src, dst))
+            elif not dst_ignored and dst_file:
+                added.append((dst_file, dst))
+            elif not src_ignored:
+                removed.append(src)
+
+        return Delta(added, moved, removed)
+
+    def _moved_from(self, dest_fs):
+        # Additions with the content of a file that is due to be removed, e.g.
+        # moves reported as a removal and an addition, are applied as moves of
+        # that file on the destination. Returns the path that each of them is
+        # moved from.
+        removed = defaultdict(list)
+        for path in self.removed:
+            dest_file = dest_fs.search(path)
+            if dest_file and not dest_file.is_folder and dest_file.md5:
+                removed[dest_file.md5].append((path, dest_file))
+
+        moved_from = {}
+        for file, path in self.added:
+            candidates = removed.get(file.md5, [])
+            for i, (src, dest_file) in enumerate(candidates):
+                if file & dest_file:
+                    moved_from[path] = src
+                    del candidates[i]
+                    break
+
+        return moved_from
+
+    def _apply_added(self, source, dest, workers, timeout=None):
         source_fs, source_state = source
         dest_fs, dest_state = dest
 
-        for file, path in self.added:
+        moved_from = self._moved_from(dest_fs)
+
+        def add(file, path, parent=None):
+            if parent:
+                parent.result()  # Wait for the parent folder to be created
+
             LOGGER.debug(f"Adding file at {path} on {dest_fs}")
             dest_file = dest_fs.search(path)
 
-            if not (file & dest_file):
-                if file.is_folder:
-                    dest_fs.makedirs(path)
-                    dest_file = wait_dir(dest_fs, path)
-                else:
-                    stream = source_fs.read(path)
-                    if stream:
-                        dest_fs.write(stream, path, file.modified_date)
-                        dest_file = wait(file, dest_fs, path)
+            try:
+                if not (file & dest_file):
+                    if file.is_folder:
+                        dest_fs.makedirs(path)
+                        dest_file = wait_dir(dest_fs, path, timeout)
+                    elif path in moved_from:
+                        src = moved_from[path]
+                        LOGGER.debug(f"Moving removed {src} -> {path} on {dest_fs}")
+                        dest_fs.move(src, path)
+                        dest_file = wait(file, dest_fs, path, timeout)
+                    else:
+                        dest_file = (
+                            _transfer(file, source_fs, dest_fs, path, timeout)
+                            or dest_file
+                        )
+            except (TimeoutError, TransferError) as e:
+                _not_applied("add", path, dest_fs, e)
+                return
 
             dest_state.add(dest_file, path)
             source_state.add(file, path)
 
-        for src, dst in self.moved:
-            LOGGER.debug(f"Moving {src} -> {dst} on {dest_fs}")
+        if workers <= 1:
+            for file, path in self.added:
+                add(file, path)
+            return
+
+        # Only the last addition to each path matters. Sorting by path ensures
+        # that folders are submitted before their content, so that waiting on
+        # a parent folder never blocks the worker that is due to create it.
+        added = sorted({p: f for f, p in self.added}.items())
+
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="Transfer"
+        ) as pool:
+            folders = {}
+            futures = []
+            for path, file in added:
+                head = os.path.dirname(path)
+                while head and head not in folders:
+                    head = os.path.dirname(head)
+
+                future = pool.submit(add, file, path, folders.get(head, None))
+                if file.is_folder:
+                    folders[path] = future
+                futures.append(future)
 
-            # src file has been moved/removed
-            source_src_file = source_state[src]
-            if not source_src_file:
-                continue
+            for future in futures:
+                future.result()
+
+    def _apply_moved(self, src, dst, source, dest, timeout=None):
+        source_fs, source_state = source
+        dest_fs, dest_state = dest
+
+        LOGGER.debug(f"Moving {src} -> {dst} on {dest_fs}")
+
+        # src file has been moved/removed
+        source_src_file = source_state[src]
+        if not source_src_file:
+            return
+
+        source_dst_file = source_fs.search(dst)
+        if not source_src_file:
+            raise RuntimeError(
+                f"Destination file is unexpectedly missing from source {source_fs}."
+            )
+
+        dest_src_file = dest_fs.search(src)
+        dest_dst_file = dest_fs.search(dst)
+
+        if dest_src_file:
+            if source_src_file & dest_src_file or (
+                source_src_file.is_folder and dest_src_file.is_folder
+            ):
+                LOGGER.debug("Source files match at both end: moving.")
+                dest_fs.move(src, dst)
+                dest_dst_file = (
+                    wait(source_dst_file, dest_fs, dst, timeout)
+                    if not source_src_file.is_folder
+                    else wait_dir(dest_fs, dst, timeout)
+                )
 
-            source_dst_file = source_fs.search(dst)
-            if not source_src_file:
-                raise RuntimeError(
-                    f"Destination file is unexpectedly missing from source {source_fs}."
+                # The states only record the move once it has taken place.
+                dest_state.move(src, dst)
+            else:
+                LOGGER.debug("Source files don't match: deleting destination source.")
+                dest_fs.remove(src)
+                wait_removed(dest_fs, src, timeout)
+
+        if not source_dst_file.is_folder and not (source_dst_file & dest_dst_file):
+            LOGGER.debug("Destination files don't match: (over)writing.")
+            LOGGER.trace(source_dst_file)
+            LOGGER.trace(dest_dst_file)
+            if source_dst_file.is_folder:
+                dest_fs.makedirs(dst)
+                dest_dst_file = wait_dir(dest_fs, dst, timeout)
+            else:
+                dest_dst_file = (
+                    _transfer(source_dst_file, source_fs, dest_fs, dst, timeout)
+                    or dest_dst_file
                 )
 
-            dest_src_file = dest_fs.search(src)
-            dest_dst_file = dest_fs.search(dst)
-
-            if dest_src_file:
-                if source_src_file & dest_src_file or (
-                    source_src_file.is_folder and dest_src_file.is_folder
-                ):
-                    LOGGER.debug("Source files match at both end: moving.")
-                    dest_fs.move(src, dst)
-                    dest_state.move(src, dst)
-
-                    dest_dst_file = (
-                        wait(source_dst_file, dest_fs, dst)
-                        if not source_src_file.is_folder
-                        else wait_dir(dest_fs, dst)
-                    )
-                else:
-                    LOGGER.debug(
-                        "Source files don't match: deleting destination source."
-                    )
-                    dest_fs.remove(src)
-                    wait_removed(dest_fs, src)
-
-            if not source_dst_file.is_folder and not (source_dst_file & dest_dst_file):
-                LOGGER.debug("Destination files don't match: (over)writing.")
-                LOGGER.trace(source_dst_file)
-                LOGGER.trace(dest_dst_file)
-                if source_dst_file.is_folder:
-                    dest_fs.makedirs(dst)
-                    dest_dst_file = wait_dir(dest_fs, dst)
-                else:
-                    stream = source_fs.read(dst)
-                    if stream:
-                        dest_fs.write(stream, dst, source_dst_file.modified_date)
-                        dest_dst_file = wait(source_dst_file, dest_fs, dst)
-
-            dest_state.add(dest_dst_file, dst)
-            dest_state.remove(src)
-
-            source_state.move(src, dst)
+        dest_state.add(dest_dst_file, dst)
+        dest_state.remove(src)
+
+        source_state.move(src, dst)
+
+    def apply(self, source, dest, workers=1, timeout=None):
+        # Additions are transferred by the given number of workers in
+        # parallel, or moved from paths that are due to be removed when they
+        # have the same content. Moves and removals are applied afterwards, in
+        # order. The changes that do not show up on the destination within
+        # timeout seconds are left out of the states, so that they are picked
+        # up again on the next start.
+        source_fs, source_state = source
+        dest_fs, dest_state = dest
+
+        self._apply_added(source, dest, workers, timeout)
+
+        for src, dst in self.moved:
+            try:
+                self._apply_moved(src, dst, source, dest, timeout)
+            except (TimeoutError, TransferError) as e:
+                _not_applied("move", f"{src} -> {dst}", dest_fs, e)
+
+        # Removals are independent of one another, so they are sent in batches
+        # where the destination supports it.
+        with dest_fs.batch():
+            for path in self.removed:
+                LOGGER.debug(f"Removing file at {path} from {dest_fs}")
+                dest_fs.remove(path)
 
         for path in self.removed:
-            LOGGER.debug(f"Removing file at {path} from {dest_fs}")
-            dest_fs.remove(path)
-            wait_removed(dest_fs, path)
+            try:
+                wait_removed(dest_fs, path, timeout)
+            except TimeoutError as e:
+                _not_applied("remove", path, dest_fs, e)
+                continue
 
             dest_state.remove(path)
             source_state.remove(path)
 
 
 class State(ABC):
+    ignore = None  # Ignore rules for the paths of the file system
+
     def __init__(self):
-        self._data = {"by_id": defaultdict(dict), "by_path": {}}
+        # Each state serialises the changes made to it, as concurrent ones
+        # might be made by operations on unrelated paths, and notifies its
+        # waiters through a condition on the same lock.
+        self._lock = RLock()
+        self._changed = Condition(self._lock)
+        self._data = {
+            "by_id": defaultdict(dict),
+            "by_path": {},
+            "by_md5": defaultdict(dict),  # Content index of the files
+        }
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_lock", None)
+        state.pop("_changed", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = RLock()
+        self._changed = Condition(self._lock)
+
+        # States saved before the content index was introduced are indexed
+        # on load.
+        if "by_md5" not in self._data:
+            self._data["by_md5"] = defaultdict(dict)
+            for path, file in self._data["by_path"].items():
+                self._add_by_md5(file, path)
 
     def __getitem__(self, path):
         return self._data["by_path"].get(path, None)
@@ -215,7 +409,8 @@ class State(ABC):
         self.add(file, path)
 
     def __iter__(self):
-        return iter(self._data["by_path"].items())
+        with self._lock:
+            return iter(list(self._data["by_path"].items()))
 
     def _del_by_id(self, file, path):
         bucket = self._data["by_id"][file.id]
@@ -223,6 +418,24 @@ class State(ABC):
         if not bucket:
             del self._data["by_id"][file.id]
 
+    def _add_by_md5(self, file, path):
+        if not file.is_folder and file.md5:
+            self._data["by_md5"][file.md5][path] = file
+
+    def _del_by_md5(self, file, path):
+        if file.is_folder or not file.md5:
+            return
+        bucket = self._data["by_md5"][file.md5]
+        bucket.pop(path, None)
+        if not bucket:
+            del self._data["by_md5"][file.md5]
+
+    def find(self, md5):
+        # A (path, file) pair with the given content, if any.
+        with self._lock:
+            bucket = self._data["by_md5"].get(md5, None)
+            return next(iter(bucket.items())) if bucket else None
+
     @classmethod
     def from_file_list(cls, files):
         state = cls()
@@ -245,16 +458,35 @@ class State(ABC):
             fo.flush()
 
     def add(self, file, path):
-        self.remove(path)  # Remove any existing file at path
-        self._data["by_id"][file.id][path] = self._data["by_path"][path] = file
+        with self._lock:
+            self.remove(path)  # Remove any existing file at path
+            self._data["by_id"][file.id][path] = self._data["by_path"][path] = file
+            self._add_by_md5(file, path)
+            self._changed.notify_all()
 
     def remove(self, path):
-        try:
-            self._del_by_id(self._data["by_path"].pop(path), path)
-        except KeyError:
-            pass
+        with self._lock:
+            try:
+                file = self._data["by_path"].pop(path)
+            except KeyError:
+                return
+            self._del_by_id(file, path)
+            self._del_by_md5(file, path)
+            self._changed.notify_all()
+
+    def wait_for(self, path, predicate, timeout=None):
+        # Block until the file at path, or None if there is none, satisfies
+        # the predicate and return it. Raises TimeoutError on timeout.
+        with self._lock:
+            if not self._changed.wait_for(lambda: predicate(self[path]), timeout):
+                raise TimeoutError(path)
+            return self[path]
 
     def move(self, src, dst):
+        with self._lock:
+            self._move(src, dst)
+
+    def _move(self, src, dst):
         try:
             if self[src].is_folder:
                 for p in [p for p, _ in self if p.startswith(src + "/")]:
@@ -269,6 +501,13 @@ class State(ABC):
             pass
 
     def __sub__(self, prev):
+        # Both states are held while they are compared, in a consistent order
+        # to avoid deadlocks with concurrent comparisons.
+        first, second = sorted((self, prev), key=id)
+        with first._lock, second._lock:
+            return self._sub(prev)
+
+    def _sub(self, prev):
         curr_state, prev_state = self._data, prev._data
 
         curr_ids = curr_state["by_id"]
@@ -308,7 +547,7 @@ class State(ABC):
             added=sorted(added, key=lambda x: x[1]),
             moved=moved,
             removed=sorted(removed, reverse=True),
-        )
+        ).filter(self.ignore or prev.ignore, self)
 
 
 class FileSystem(ABC):
@@ -363,3 +602,15 @@ class FileSystem(ABC):
     @abstractmethod
     def conflict(self, file: File):
         pass
+
+    def reuse(self, file: File, path: str) -> bool:
+        # File systems that can create a file from content they have already
+        # do so here, rather than having it transferred. Returns whether the
+        # file has been created.
+        return False
+
+    @contextmanager
+    def batch(self):
+        # File systems that can send many operations in one go collect them
+        # within this context and perform them on exit.
+        yield
@@ -0,0 +1,143 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import os
+import pickle
+from threading import RLock
+
+from erwin.logging import LOGGER
+
+
+def stat_key(stat):
+    return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+# Hashes are keyed by (device, inode, size, mtime_ns) so that any change to the
+# content of a file invalidates its entry, whereas renames and moves within the
+# same device still hit the cache. When the cap on the number of entries is
+# reached, the least recently used ones are evicted first.
+class HashCache:
+    VERSION = 1
+
+    def __init__(self, cache_file=None, max_entries=1 << 20):
+        self._cache_file = cache_file
+        self._max_entries = max_entries
+        self._lock = RLock()
+
+        self._hashes = OrderedDict()  # key -> (md5, path)
+        self._keys = {}  # path -> key
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def __contains__(self, key):
+        return key in self._hashes
+
+    @classmethod
+    def load(cls, cache_file, max_entries=1 << 20):
+        cache = cls(cache_file, max_entries)
+        if not cache_file:
+            return cache
+
+        try:
+            with open(cache_file, "rb") as fi:
+                version, hashes = pickle.load(fi)
+            if version != cls.VERSION:
+                raise ValueError(f"unsupported version {version}")
+        except FileNotFoundError:
+            return cache
+        except Exception as e:
+            # The cache can be rebuilt, so one that cannot be read for any
+            # reason, e.g. because a save was interrupted, is thrown away.
+            LOGGER.warning(f"Hash cache {cache_file} not available. Reason: {e}.")
+            return cache
+
+        for key, (md5, path) in hashes.items():
+            cache._store(key, md5, path)
+        LOGGER.debug(f"Loaded {len(cache)} entries from hash cache {cache_file}")
+
+        return cache
+
+    def save(self):
+        if not self._cache_file:
+            return
+
+        with self._lock:
+            hashes = OrderedDict(self._hashes)
+
+        # Write to a temporary file first, so that an interrupted save does not
+        # leave a truncated cache behind.
+        temp_file = self._cache_file + ".tmp"
+        with open(temp_file, "wb") as fo:
+            pickle.dump((self.VERSION, hashes), fo)
+        os.replace(temp_file, self._cache_file)
+
+    def _store(self, key, md5, path):
+        old_key = self._keys.get(path, None)
+        if old_key is not None and old_key != key:
+            self._hashes.pop(old_key, None)
+
+        old_entry = self._hashes.pop(key, None)
+        if old_entry and self._keys.get(old_entry[1], None) == key:
+            del self._keys[old_entry[1]]
+
+        self._hashes[key] = (md5, path)
+        self._keys[path] = key
+
+        while len(self._hashes) > self._max_entries:
+            _, (_, evicted_path) = self._hashes.popitem(last=False)
+            self._keys.pop(evicted_path, None)
+
+    def get(self, key, path=None):
+        # A hit refreshes the entry and records the path the file has been
+        # found at, if given, which differs from the original one if it has
+        # been moved.
+        with self._lock:
+            entry = self._hashes.get(key, None)
+            if entry is None:
+                return None
+
+            md5, old_path = entry
+            self._store(key, md5, path or old_path)
+
+            return md5
+
+    def put(self, key, path, md5):
+        with self._lock:
+            self._store(key, md5, path)
+
+    def discard(self, path):
+        with self._lock:
+            key = self._keys.pop(path, None)
+            if key is not None:
+                self._hashes.pop(key, None)
+
+    def prune(self, paths):
+        # Drop the entries of all the paths that no longer exist.
+        with self._lock:
+            stale = [p for p in self._keys if p not in paths]
+            for path in stale:
+                self._hashes.pop(self._keys.pop(path), None)
+
+        if stale:
+            LOGGER.debug(f"Pruned {len(stale)} stale entries from the hash cache")
@@ -20,28 +20,46 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import datetime
-from httplib2 import Http, ServerNotFoundError
+import hashlib
+import json
+from httplib2 import ServerNotFoundError
 import io
 import mimetypes
 import pickle
+import os
+import random
+import socket
+import sys
 import os.path
 from pprint import pprint as pp
-from queue import Queue
-from threading import Event, RLock, Thread
-from time import sleep
+from queue import Empty, Full, Queue
+from threading import Event, Lock, RLock, Thread, local
+from types import SimpleNamespace
+from uuid import uuid4
+from time import sleep, time
 
 from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
-from googleapiclient.http import HttpRequest, MediaIoBaseDownload, MediaIoBaseUpload
+from googleapiclient.http import (
+    build_http,
+    HttpRequest,
+    MediaIoBaseDownload,
+    MediaIoBaseUpload,
+)
 from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.exceptions import TransportError
 from google.auth.transport.requests import Request
 
 
+from erwin.flow import bounded_map, TokenBucket
 from erwin.fs import Delta, File, FileSystem, FSNotReady, State
+from erwin.fs.ignore import IgnoreRules
+from erwin.fs.notify import PollScheduler, WebhookListener
 from erwin.logging import LOGGER
 
 
@@ -59,6 +77,7 @@ _FILE_FIELDS = [
     "modifiedTime",
     # "createdTime",
     "md5Checksum",
+    "size",
     "name",
     "exportLinks",
     # "driveId",
@@ -71,6 +90,83 @@ class UnknownParent(Exception):
     pass
 
 
+# Resumable upload sessions, keyed by the path of the file being uploaded. Each
+# session carries a fingerprint of the upload (target, size and modified date of
+# the content) so that it is only resumed if the same content is uploaded to the
+# same target again. The sessions are persisted as soon as they change, so that
+# an interrupted upload can be resumed after a restart.
+class UploadSessions:
+    VERSION = 1
+    TTL = 6 * 24 * 3600  # Drive expires resumable sessions after a week
+
+    def __init__(self, sessions_file=None):
+        self._sessions_file = sessions_file
+        self._sessions = {}  # path -> (fingerprint, uri, created)
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @classmethod
+    def load(cls, sessions_file):
+        sessions = cls(sessions_file)
+        if not sessions_file:
+            return sessions
+
+        try:
+            with open(sessions_file, "rb") as fi:
+                version, entries = pickle.load(fi)
+            if version != cls.VERSION:
+                raise ValueError(f"unsupported version {version}")
+        except FileNotFoundError:
+            return sessions
+        except (IOError, EOFError, ValueError) as e:
+            LOGGER.warning(
+                f"Upload sessions {sessions_file} not available. Reason: {e}."
+            )
+            return sessions
+
+        now = time()
+        sessions._sessions = {
+            path: entry for path, entry in entries.items() if now - entry[2] < cls.TTL
+        }
+        LOGGER.debug(f"Loaded {len(sessions)} upload sessions from {sessions_file}")
+
+        return sessions
+
+    def _save(self):
+        if not self._sessions_file:
+            return
+
+        temp_file = self._sessions_file + ".tmp"
+        with open(temp_file, "wb") as fo:
+            pickle.dump((self.VERSION, self._sessions), fo)
+        os.replace(temp_file, self._sessions_file)
+
+    def get(self, path, fingerprint):
+        with self._lock:
+            entry = self._sessions.get(path, None)
+            if entry is None:
+                return None
+
+            session_fingerprint, uri, created = entry
+            if session_fingerprint != fingerprint or time() - created >= self.TTL:
+                self.discard(path)
+                return None
+
+            return uri
+
+    def put(self, path, fingerprint, uri):
+        with self._lock:
+            self._sessions[path] = (fingerprint, uri, time())
+            self._save()
+
+    def discard(self, path):
+        with self._lock:
+            if self._sessions.pop(path, None) is not None:
+                self._save()
+
+
 def suppresserror(f):
     def wrapper(*args, **kwargs):
         try:
@@ -122,16 +218,569 @@ def _children_map(object_list):
     return children_map
 
 
+def _order_changes(changes):
+    # Only the latest change to each file matters, as it carries the current
+    # metadata of the file. Changes to folders are then sorted before the
+    # changes to their content (Kahn's algorithm), so that parents are known by
+    # the time their children are processed. Any cycle is left in the order
+    # the changes were received.
+    latest = OrderedDict()
+    for change in changes:
+        latest.pop(change["fileId"], None)
+        latest[change["fileId"]] = change
+
+    children = defaultdict(list)
+    indegree = {}
+    for file_id, change in latest.items():
+        parents = [
+            p
+            for p in change.get("file", {}).get("parents", [])
+            if p in latest and p != file_id
+        ]
+        indegree[file_id] = len(parents)
+        for parent in parents:
+            children[parent].append(file_id)
+
+    queue = deque(file_id for file_id, n in indegree.items() if not n)
+    ordered = deque()
+    while queue:
+        file_id = queue.popleft()
+        ordered.append(latest[file_id])
+        for child in children[file_id]:
+            indegree[child] -= 1
+            if not indegree[child]:
+                queue.append(child)
+
+    if len(ordered) < len(latest):
+        ordered.extend(latest[file_id] for file_id, n in indegree.items() if n)
+
+    return ordered
+
+
+# Fields of the Drive files kept in the snapshot of the file map, which are the
+# only ones needed to rebuild the state and to process changes.
+_SNAPSHOT_FIELDS = (
+    "name",
+    "parents",
+    "mimeType",
+    "md5Checksum",
+    "modifiedTime",
+    "size",
+)
+
+
+def _compact(df):
+    # The values that repeat across files, like MIME types and the ids of the
+    # parents, are interned so that they are pickled only once.
+    values = []
+    for field in _SNAPSHOT_FIELDS:
+        value = df.get(field, None)
+        if field == "parents" and value is not None:
+            value = tuple(sys.intern(p) for p in value)
+        elif field == "mimeType" and value is not None:
+            value = sys.intern(value)
+        values.append(value)
+    return tuple(values)
+
+
+def _expand(_id, values):
+    df = {f: v for f, v in zip(_SNAPSHOT_FIELDS, values) if v is not None}
+    df["id"] = _id
+    if "parents" in df:
+        df["parents"] = list(df["parents"])
+    return df
+
+
+def _round_ms(dt):
+    ms = datetime.timedelta(milliseconds=1)
+    return datetime.datetime.min + round((dt - datetime.datetime.min) / ms) * ms
+
+
+def _to_drive_time(dt):
+    # Drive keeps modified times to the millisecond, so they are rounded to
+    # that precision before being sent, so that they come back unchanged.
+    dt = _round_ms(dt)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + f"{dt.microsecond // 1000:03d}Z"
+
+
 def _is_folder(file):
     return file.get("mimeType", None) == GoogleDriveFS.FOLDER_MIMETYPE
 
 
+# A read-only stream fed by a download that runs in a separate thread. At most
+# `depth` chunks are buffered at any time, so the memory in use is bounded by the
+# download chunk size rather than by the size of the file. Closing the stream
+# before the end of the content aborts the download.
+class DownloadStream(io.RawIOBase):
+    _EOF = object()
+
+    def __init__(self, fetch, depth=2):
+        self._fetch = fetch  # Writes the content to the object it is passed
+        self._queue = Queue(maxsize=depth)
+        self._aborted = Event()
+        self._chunk = memoryview(b"")
+        self._eof = False
+        self._thread = Thread(target=self._produce, name="Download", daemon=True)
+
+    def start(self):
+        # Wait for the first chunk, so that the errors that occur when the
+        # download is requested are raised to the caller.
+        if self._thread.ident is None:
+            self._thread.start()
+            self._next()
+        return self
+
+    def _put(self, item):
+        while not self._aborted.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def _write(self, data):
+        if self._aborted.is_set():
+            raise IOError("Download aborted")
+        if data:
+            self._put(bytes(data))
+        return len(data)
+
+    def _produce(self):
+        try:
+            self._fetch(SimpleNamespace(write=self._write))
+            self._put(self._EOF)
+        except BaseException as e:
+            self._put(e)
+
+    def _next(self):
+        item = self._queue.get()
+        if item is self._EOF:
+            self._eof = True
+        elif isinstance(item, BaseException):
+            self._eof = True
+            raise item
+        else:
+            self._chunk = memoryview(item)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        self.start()
+
+        while not self._chunk:
+            if self._eof:
+                return 0
+            self._next()
+
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+    def close(self):
+        self._aborted.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except Empty:
+            pass
+        super().close()
+
+
+# A download of a large file in segments that are fetched concurrently with
+# HTTP range requests. When the destination is a local file, the segments are
+# written straight to their offset with write_to. Otherwise, the content is
+# streamed sequentially like any other download.
+class RangedDownload(DownloadStream):
+    def __init__(self, fetch, fetch_range, size, md5, segment_size, workers):
+        super().__init__(fetch)
+        self._fetch_range = fetch_range  # Returns the bytes in [start, end]
+        self._size = size
+        self._md5 = md5
+        self._segment_size = segment_size
+        self._workers = workers
+
+    def _preallocate(self, fd):
+        try:
+            os.posix_fallocate(fd, 0, self._size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, self._size)
+
+    def write_to(self, fout):
+        # Download the content to the given regular file and return its MD5
+        # hash, which is checked against the one of the remote file. Segments
+        # are hashed in order as they complete, so at most a window of them
+        # is held in memory at any time.
+        fd = fout.fileno()
+        self._preallocate(fd)
+
+        def fetch_segment(start):
+            if self._aborted.is_set():
+                raise IOError("Download aborted")
+            end = min(start + self._segment_size, self._size) - 1
+            data = self._fetch_range(start, end)
+            if len(data) != end - start + 1:
+                raise IOError(f"Expected {end - start + 1} bytes, got {len(data)}")
+            view = memoryview(data)
+            while view:
+                view = view[os.pwrite(fd, view, start + len(data) - len(view)) :]
+            return data
+
+        hash_md5 = hashlib.md5()
+        with ThreadPoolExecutor(
+            max_workers=self._workers, thread_name_prefix="Segment"
+        ) as pool:
+            try:
+                for data in bounded_map(
+                    pool,
+                    fetch_segment,
+                    range(0, self._size, self._segment_size),
+                    self._workers * 2,
+                ):
+                    hash_md5.update(data)
+            except BaseException:
+                self._aborted.set()  # Skip the segments not yet started
+                raise
+
+        md5 = hash_md5.hexdigest()
+        if md5 != self._md5:
+            raise IOError(f"MD5 mismatch on ranged download: {md5} != {self._md5}")
+
+        return md5
+
+
+# Governor of the requests to the Drive API. Requests are paced by a token
+# bucket sized to the API quota, and those that fail because of rate limits,
+# server errors or dropped connections are retried with exponential backoff and
+# full jitter. This is the only retry layer for requests that can be sent
+# again, so callers do not retry them on their own. Counters of the throttling
+# that has taken place are kept for reporting.
+class RequestGovernor:
+    RATE_LIMIT_REASONS = {"userRateLimitExceeded", "rateLimitExceeded"}
+    TRANSIENT = {429, 500, 502, 503, 504}
+
+    def __init__(self, rate=10, burst=20, retries=8, delay=1, cap=64):
+        self._bucket = TokenBucket(rate, burst)
+        self._retries = retries
+        self._delay = delay
+        self._cap = cap
+
+        self._lock = RLock()
+        self._metrics = {
+            "requests": 0,
+            "throttled": 0,
+            "retries": 0,
+            "failures": 0,
+            "wait_time": 0.0,
+            "backoff_time": 0.0,
+        }
+
+    def _count(self, **increments):
+        with self._lock:
+            for k, v in increments.items():
+                self._metrics[k] += v
+
+    @property
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics)
+
+    def acquire(self, tokens=1):
+        self._count(requests=tokens, wait_time=self._bucket.acquire(tokens))
+
+    def is_retryable(self, status, content):
+        if status in self.TRANSIENT:
+            return True
+        if status != 403:
+            return False
+
+        try:
+            errors = json.loads(content)["error"]["errors"]
+        except (ValueError, KeyError, TypeError):
+            return False
+
+        return any(e.get("reason", None) in self.RATE_LIMIT_REASONS for e in errors)
+
+    def backoff(self, attempt, status):
+        delay = random.uniform(0, min(self._cap, self._delay * 2 ** attempt))
+        self._count(throttled=int(status in (403, 429)), retries=1, backoff_time=delay)
+        LOGGER.warning(
+            f"Drive request failed with status {status}. Retrying in {delay:.1f} "
+            f"seconds. {self.metrics}"
+        )
+        sleep(delay)
+
+    def request(self, http, uri, method="GET", body=None, headers=None, **kwargs):
+        # Requests are sent again as they are. This covers metadata requests,
+        # the initiation of resumable uploads and their chunks, which are sent
+        # as bytes. Streamed bodies cannot be rewound from here, so they are
+        # never retried.
+        retries = self._retries if not hasattr(body, "read") else 0
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                resp, content = http.request(
+                    uri, method, body=body, headers=headers, **kwargs
+                )
+            except (ConnectionError, socket.timeout) as e:
+                if attempt >= retries:
+                    self._count(failures=1)
+                    raise
+                self.backoff(attempt, type(e).__name__)
+                attempt += 1
+                continue
+
+            if not self.is_retryable(resp.status, content):
+                return resp, content
+
+            if attempt >= retries:
+                self._count(failures=1)
+                return resp, content
+
+            self.backoff(attempt, resp.status)
+            attempt += 1
+
+
+# Pool of Http objects, each of which keeps its connections alive across the
+# requests it makes. As Http objects are not thread-safe, every request checks
+# one out for its sole use and returns it to the pool when done. At most size
+# objects are created, and requests beyond that wait for one to be returned.
+class HttpPool:
+    def __init__(self, size=16, factory=build_http):
+        self._size = size
+        self._factory = factory  # build_http does not follow 308 responses
+        self._idle = Queue()
+        self._created = 0
+        self._lock = Lock()
+
+    def __len__(self):
+        return self._created
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            if self._created < self._size:
+                self._created += 1
+                return self._factory()
+
+        return self._idle.get()
+
+    def request(self, *args, **kwargs):
+        http = self._checkout()
+        try:
+            return http.request(*args, **kwargs)
+        finally:
+            self._idle.put(http)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+
+# An Http object whose requests are all made through the governor.
+class GovernedHttp:
+    def __init__(self, http, governor):
+        self._http = http
+        self._governor = governor
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        return self._governor.request(
+            self._http, uri, method, body=body, headers=headers, **kwargs
+        )
+
+    def __getattr__(self, name):
+        return getattr(self._http, name)
+
+
+# Metadata requests that are independent of one another, queued to be sent in
+# batches of at most MAX_SIZE through the batch endpoint. The callback of each
+# request is called with its response. Items that fail with a transient error
+# are sent again with the next batch, whereas the other failed items, and all
+# the items of a batch that fails as a whole, are sent again on their own, as
+# they would be outside of a batch.
+class MetadataBatch:
+    MAX_SIZE = 100
+    RETRIES = 3
+    TRANSIENT = {429, 500, 502, 503, 504}
+
+    def __init__(self, drive, governor=None):
+        self._drive = drive
+        self._governor = governor
+        self._requests = []  # (request, callback, attempts)
+
+    def __len__(self):
+        return len(self._requests)
+
+    def add(self, request, callback):
+        self._requests.append((request, callback, 0))
+        if len(self._requests) >= self.MAX_SIZE:
+            self._send_next()
+
+    def _execute(self, requests):
+        retry, failed = [], []
+
+        def on_response(request_id, response, exception):
+            request, callback, attempts = requests[int(request_id)]
+            if exception is None:
+                callback(response)
+                return
+
+            status = getattr(getattr(exception, "resp", None), "status", None)
+            if status in self.TRANSIENT and attempts < self.RETRIES:
+                retry.append((request, callback, attempts + 1))
+            else:
+                LOGGER.warning(
+                    f"Batched request {request.uri} failed: {exception}. "
+                    "Sending it on its own."
+                )
+                failed.append((request, callback, attempts))
+
+        batch = self._drive.new_batch_http_request(callback=on_response)
+        for i, (request, _, _) in enumerate(requests):
+            batch.add(request, request_id=str(i))
+
+        # Each item counts against the quota, but the batch itself is paced
+        # as a single request.
+        if self._governor and len(requests) > 1:
+            self._governor.acquire(len(requests) - 1)
+        batch.execute()
+
+        return retry, failed
+
+    @suppresserror
+    def _send(self):
+        # The requests are only dropped from the queue once the batch has been
+        # sent, so that they are sent again if the connection drops. Requests
+        # that failed with a transient error are queued again with a delay.
+        requests = self._requests[: self.MAX_SIZE]
+        retry, failed = self._execute(requests)
+        self._requests = self._requests[len(requests) :] + retry
+
+        for request, callback, _ in failed:
+            self._send_one(request, callback)
+
+        if retry:
+            sleep(2 ** max(attempts for _, _, attempts in retry))
+
+        return True
+
+    @suppresserror
+    def _send_one(self, request, callback):
+        callback(request.execute())
+
+    def _send_next(self):
+        if not self._send():
+            # The batch has failed as a whole and the error has been logged
+            # already, so its requests are sent one by one.
+            requests = self._requests[: self.MAX_SIZE]
+            self._requests = self._requests[len(requests) :]
+            for request, callback, _ in requests:
+                self._send_one(request, callback)
+
+    def flush(self):
+        while self._requests:
+            self._send_next()
+
+
+# Index of the paths of Drive files, by id and by path. The path of a file is
+# resolved through the path of its (first) parent, which is cached in turn, so
+# that each lookup costs a single step once the ancestors are known. When the
+# name or the parent of a file changes, the paths of its whole subtree are
+# rewritten. Nothing is cached for files whose ancestors are not all known.
+class PathIndex:
+    def __init__(self, file_map):
+        self._file_map = file_map  # id -> Drive file
+        self._lock = RLock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._paths = {}  # id -> (path, name, parent)
+            self._ids = {}  # path -> id
+            self._children = defaultdict(set)  # id -> ids of indexed children
+
+    def __len__(self):
+        return len(self._paths)
+
+    def id(self, path):
+        return self._ids.get(path, None)
+
+    def path(self, df):
+        _id, name = df["id"], df["name"]
+        parents = df.get("parents", None)
+        parent = parents[0] if parents else None
+
+        with self._lock:
+            entry = self._paths.get(_id, None)
+            if entry and entry[1:] == (name, parent):
+                return entry[0]
+
+            if parent is None:
+                path = name
+            else:
+                try:
+                    parent_df = self._file_map[parent]
+                except KeyError as e:
+                    raise UnknownParent() from e
+                path = self.path(parent_df) + "/" + name
+
+            self._set(_id, path, name, parent)
+
+            return path
+
+    def _set(self, _id, path, name, parent):
+        old_entry = self._paths.get(_id, None)
+        if old_entry:
+            old_path, _, old_parent = old_entry
+            if self._ids.get(old_path, None) == _id:
+                del self._ids[old_path]
+            self._children[old_parent].discard(_id)
+
+        self._paths[_id] = (path, name, parent)
+        self._ids[path] = _id
+        self._children[parent].add(_id)
+
+        if old_entry and old_entry[0] != path:
+            # Rewrite the paths of the subtree
+            for child in list(self._children.get(_id, ())):
+                _, child_name, _ = self._paths[child]
+                self._set(child, path + "/" + child_name, child_name, _id)
+
+    def discard(self, _id):
+        # Drop the file together with its subtree, whose paths are resolved
+        # again if it shows up anew.
+        with self._lock:
+            for child in list(self._children.pop(_id, ())):
+                self.discard(child)
+
+            entry = self._paths.pop(_id, None)
+            if entry is None:
+                return
+
+            path, _, parent = entry
+            if self._ids.get(path, None) == _id:
+                del self._ids[path]
+            self._children[parent].discard(_id)
+
+
 class GoogleDriveFile(File):
-    def __init__(self, md5, is_folder, modified_date, _id, mime_type, parents):
+    def __init__(
+        self, md5, is_folder, modified_date, _id, mime_type, parents, size=None
+    ):
         super().__init__(md5, is_folder, modified_date)
         self._id = _id
         self.mime_type = mime_type
         self.parents = parents
+        self.size = size
 
     @property
     def id(self):
@@ -173,12 +822,69 @@ class GoogleDriveFS(FileSystem):
 
     DIR_FIELDS = ",".join(["id", "name", "mimeType", "parents"])
 
+    MAX_PENDING_CHANGES = 10000
+    MAX_TRASHED = 1000
+    TRASHED_TTL = 600  # Seconds for which trashed files are restored for reuse
+    SNAPSHOT_VERSION = 1
+
+    CHANNEL_TTL = 24 * 3600  # Lifetime requested for push channels
+    CHANNEL_RENEWAL = 300  # Seconds before expiry at which channels are renewed
+
     FILE_FIELDS = ",".join(_FILE_FIELDS)
 
-    def __init__(self, token):
+    UPLOAD_CHUNK_ALIGNMENT = 256 << 10  # Required by the Drive API
+
+    def __init__(
+        self,
+        token,
+        ignore=None,
+        chunk_size=8 << 20,
+        upload_sessions=None,
+        snapshot=None,
+        download_workers=4,
+        download_segment_size=32 << 20,
+        download_threshold=64 << 20,
+        poll_min_interval=1,
+        poll_max_interval=60,
+        webhook_address=None,
+        webhook_host="127.0.0.1",
+        webhook_port=8080,
+        rate_limit=10,
+        rate_burst=20,
+        max_retries=8,
+        http_pool_size=16,
+    ):
         self._drive = None
         self._changes_token = None
         self._state = None
+        self._ignore = ignore if ignore is not None else IgnoreRules()
+        self._makedirs_lock = RLock()  # Avoid duplicate concurrent folders
+        self._governor = RequestGovernor(rate_limit, rate_burst, max_retries)
+        self._local = local()  # Per-thread metadata batch
+        self._file_map = {}
+        self._paths = PathIndex(self._file_map)
+        self._pending_changes = OrderedDict()  # Changes with unknown parents
+        self._trashed = OrderedDict()  # Files recently trashed by us, by MD5
+        self._snapshot = snapshot  # File with the file map and changes token
+
+        # Changes are polled at an adaptive interval. Optionally, the polls are
+        # triggered by push notifications sent to the webhook address, which
+        # should forward them to the local listener. This is started once the
+        # API is reachable, so that retries do not bind the port again.
+        self._scheduler = PollScheduler(poll_min_interval, poll_max_interval)
+        self._webhook_address = webhook_address
+        self._webhook = None
+        self._channel = None
+
+        # Chunks of resumable uploads must be multiples of 256 KiB.
+        alignment = self.UPLOAD_CHUNK_ALIGNMENT
+        self._chunk_size = max(1, -(-chunk_size // alignment)) * alignment
+        self._uploads = UploadSessions.load(upload_sessions)
+
+        # Large files are downloaded in segments, in parallel.
+        self._download_workers = download_workers
+        self._download_segment_size = download_segment_size
+        self._download_threshold = download_threshold
 
         try:
             with open(token, "rb") as t:
@@ -199,15 +905,19 @@ class GoogleDriveFS(FileSystem):
                 with open(token, "wb") as t:
                     pickle.dump(creds, t)
 
+            http = GovernedHttp(
+                AuthorizedHttp(creds, http=HttpPool(http_pool_size)), self._governor
+            )
             self._drive = build(
                 "drive",
                 "v3",
                 credentials=creds,
                 cache_discovery=False,
-                # Create a new instance of Http to make the Google API thread-safe
+                # Requests do not share Http instances, as they are not
+                # thread-safe, but take one from a pool for each request.
                 # See https://github.com/googleapis/google-api-python-client/blob/master/docs/thread_safety.md
                 requestBuilder=lambda _, *args, **kwargs: HttpRequest(
-                    AuthorizedHttp(creds, http=Http()), *args, **kwargs
+                    http, *args, **kwargs
                 ),
             )
         except (ServerNotFoundError, TransportError) as e:
@@ -219,6 +929,11 @@ class GoogleDriveFS(FileSystem):
 
         super().__init__(self._to_file(self._droot))
 
+        if webhook_address:
+            self._webhook = WebhookListener(
+                self._on_notification, uuid4().hex, webhook_host, webhook_port
+            ).start()
+
     def _to_file(self, df):
         is_folder = _is_folder(df)
 
@@ -235,29 +950,11 @@ class GoogleDriveFS(FileSystem):
             if is_folder
             else df.get("mimeType", self.DEFAULT_MIMETYPE),
             parents=df.get("parents", []),
+            size=int(df["size"]) if "size" in df and not is_folder else None,
         )
 
-    def _get_paths(self, file, partial_path="", path_list=None):
-        if path_list is None:
-            path_list = []
-
-        partial_path = "/" + file["name"] + partial_path
-
-        parents = file.get("parents", [])
-        if not parents:
-            path_list.append(partial_path)
-            return path_list
-
-        try:
-            for parent in parents:
-                self._get_paths(self._file_map[parent], partial_path, path_list)
-        except KeyError as e:
-            raise UnknownParent() from e
-
-        return path_list
-
     def _path(self, df):
-        return self._get_paths(df)[0].lstrip("/")
+        return self._paths.path(df)
 
     def list_shared_drives(self):
         return self._drive.drives().list().execute().get("drives", [])
@@ -294,12 +991,17 @@ class GoogleDriveFS(FileSystem):
             fields=self.CHANGES_FIELDS,
         )
 
+        # The changes that could not be applied on the previous poll are tried
+        # again, unless they have been superseded.
+        changes = _order_changes(list(self._pending_changes.values()) + changes)
+        self._pending_changes.clear()
+
         added = []
         moved = []
         removed = []
 
         while changes:
-            change = changes.pop(0)
+            change = changes.popleft()
 
             file_id = change["fileId"]
             if not file_id or "file" not in change:
@@ -343,11 +1045,14 @@ class GoogleDriveFS(FileSystem):
                             new_path = self._path(dfile)
                             removed.append(old_path)
                             added.append((new_file, new_path))
+                            self.state.remove(old_path)
+                            self.state.add(new_file, new_path)
                     else:
                         path = self._path(old_dfile)
                         removed.append(path)
                         self.state.remove(path)
                         del self._file_map[file_id]
+                        self._paths.discard(file_id)
 
                 elif new_file:
                     path = self._path(dfile)
@@ -358,11 +1063,25 @@ class GoogleDriveFS(FileSystem):
                     self._file_map[file_id] = dfile
 
             except UnknownParent:
-                # Changes are not received in the "right" order so we try
-                # to deal with the current change again later on.
-                changes.append(change)
+                # The parent has not been seen yet, so we park the change until
+                # the next poll.
+                self._park_change(change)
+
+        if self._pending_changes:
+            LOGGER.debug(
+                f"{len(self._pending_changes)} Drive changes with unknown parents "
+                "postponed to the next poll"
+            )
+
+        return Delta(added, moved, removed).filter(self._ignore, self.state)
 
-        return Delta(added, moved, removed)
+    def _park_change(self, change):
+        self._pending_changes[change["fileId"]] = change
+        if len(self._pending_changes) > self.MAX_PENDING_CHANGES:
+            _, dropped = self._pending_changes.popitem(last=False)
+            LOGGER.warning(
+                f"Too many Drive changes with unknown parents. Dropping {dropped}"
+            )
 
     @suppresserror
     def get_file(self, _id):
@@ -372,34 +1091,163 @@ class GoogleDriveFS(FileSystem):
             .execute()
         )
 
+    @property
+    def metrics(self):
+        # Counters of the requests made to the Drive API and their throttling.
+        return self._governor.metrics
+
+    def _on_notification(self, headers):
+        channel = self._channel
+        if not channel or headers.get("X-Goog-Channel-ID", None) != channel["id"]:
+            return
+
+        # The first notification only confirms that the channel is open.
+        if headers.get("X-Goog-Resource-State", None) != "sync":
+            LOGGER.trace("Drive change notification received")
+            self._scheduler.trigger()
+
+    def _watch(self):
+        # Open a push notification channel for the changes, or renew the
+        # current one when it is about to expire.
+        if not self._webhook or not self._changes_token:
+            return
+
+        channel = self._channel
+        expires_in = int(channel["expiration"]) / 1000 - time() if channel else 0
+        if expires_in > self.CHANNEL_RENEWAL:
+            return
+
+        self._channel = (
+            self._drive.changes()
+            .watch(
+                pageToken=self._changes_token,
+                body={
+                    "id": uuid4().hex,
+                    "type": "web_hook",
+                    "address": self._webhook_address,
+                    "token": self._webhook.token,
+                    "expiration": int((time() + self.CHANNEL_TTL) * 1000),
+                },
+            )
+            .execute()
+        )
+        LOGGER.debug(f"Drive push channel {self._channel['id']} opened")
+
+        if channel:
+            self._drive.channels().stop(
+                body={"id": channel["id"], "resourceId": channel["resourceId"]}
+            ).execute()
+
     def get_changes(self):
-        backoff = 5
+        scheduler = self._scheduler
         while True:
-            LOGGER.trace(f"Getting Drive changes (backoff: {backoff})")
+            LOGGER.trace(f"Getting Drive changes (interval: {scheduler.interval})")
             try:
                 with STATE_LOCK:
-                    yield self._get_changes()
+                    delta = self._get_changes()
+                    if delta:
+                        scheduler.activity()
+                    else:
+                        scheduler.idle()
+                    yield delta
 
-                backoff = 5
                 CONNECTED.set()
 
+                try:
+                    self._watch()
+                except HttpError as e:
+                    LOGGER.warning(
+                        f"Cannot open a Drive push channel. Falling back to polling. "
+                        f"Reason: {e}"
+                    )
+
             except ServerNotFoundError:
-                backoff *= 1.618
+                scheduler.idle()
                 LOGGER.error(
-                    f"The Google Drive API is unreachable. Retrying in {int(backoff)} seconds."
+                    f"The Google Drive API is unreachable. Retrying in {int(scheduler.interval)} seconds."
                 )
 
             finally:
-                sleep(backoff)
+                scheduler.wait()
 
     @property
     def state(self):
         if self._state:
             return self._state
 
-        self._state = GoogleDriveFSState.from_file_list(self.list())
+        with STATE_LOCK:
+            if not self._resume():
+                self._state = GoogleDriveFSState.from_file_list(self.list())
+            self._state.ignore = self._ignore
+
         return self._state
 
+    def save_snapshot(self):
+        # Persist the changes token together with the file map it refers to,
+        # so that the next start can catch up from it.
+        if not self._snapshot or not self._changes_token:
+            return
+
+        with STATE_LOCK:
+            snapshot = (
+                self.SNAPSHOT_VERSION,
+                self._changes_token,
+                {
+                    _id: _compact(df)
+                    for _id, df in self._file_map.items()
+                    if _id != self._droot["id"] and not df.get("exportLinks", None)
+                },
+                list(self._pending_changes.values()),
+            )
+
+        temp_file = self._snapshot + ".tmp"
+        with open(temp_file, "wb") as fo:
+            pickle.dump(snapshot, fo, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, self._snapshot)
+
+    def _resume(self):
+        # Rebuild the state from the snapshot of the file map and catch up
+        # with the changes made since it was taken. Returns False if a full
+        # listing is required instead.
+        if not self._snapshot:
+            return False
+
+        try:
+            with open(self._snapshot, "rb") as fi:
+                version, token, files, pending = pickle.load(fi)
+            if version != self.SNAPSHOT_VERSION:
+                raise ValueError(f"unsupported version {version}")
+        except FileNotFoundError:
+            return False
+        except (IOError, EOFError, ValueError) as e:
+            LOGGER.warning(
+                f"Drive snapshot {self._snapshot} not available. Reason: {e}."
+            )
+            return False
+
+        self._file_map.clear()
+        self._file_map.update({_id: _expand(_id, v) for _id, v in files.items()})
+        self._file_map[self._droot["id"]] = self._droot
+        self._paths.clear()
+        self._pending_changes = OrderedDict((c["fileId"], c) for c in pending)
+        self._changes_token = token
+
+        self._state = GoogleDriveFSState.from_file_list(self._listing())
+        try:
+            self._get_changes()
+        except HttpError as e:
+            if e.resp.status not in (400, 404, 410):
+                raise
+            LOGGER.warning("The Drive changes token has expired. Listing all files.")
+            self._state = None
+            self._changes_token = None
+            self._pending_changes.clear()
+            return False
+
+        LOGGER.info(f"Drive state resumed from {self._snapshot}")
+
+        return True
+
     def search(self, path):
         with STATE_LOCK:
             return self.state[path]
@@ -407,6 +1255,11 @@ class GoogleDriveFS(FileSystem):
     def list(self):
         parent = self.root
 
+        # Changes are tracked from before the listing, so that none is missed.
+        self._changes_token = (
+            self._drive.changes().getStartPageToken().execute().get("startPageToken")
+        )
+
         query = "trashed = false"
         # if not recursive:
         #     query += f" and '{parent._id}' in parents"
@@ -417,10 +1270,21 @@ class GoogleDriveFS(FileSystem):
             fields=f"nextPageToken, files({GoogleDriveFS.FILE_FIELDS})",
         )
 
-        self._file_map = {f["id"]: f for f in file_list}
+        self._file_map.clear()
+        self._file_map.update({f["id"]: f for f in file_list})
         self._file_map[self._droot["id"]] = self._droot
+        self._paths.clear()
+        self._pending_changes.clear()
+
+        return self._listing()
 
-        file_list = [f for f in file_list if not f.get("exportLinks", None)]
+    def _listing(self):
+        # The list of (path, file) pairs in the file map, top-down.
+        file_list = [
+            f
+            for _id, f in self._file_map.items()
+            if _id != self._droot["id"] and not f.get("exportLinks", None)
+        ]
 
         sorted_list = []
         children_map = _children_map(file_list)
@@ -437,11 +1301,11 @@ class GoogleDriveFS(FileSystem):
             for f, p in [
                 (self._to_file(file), self._path(file)) for file in sorted_list
             ]
-            if f.is_folder or f.md5
+            if (f.is_folder or f.md5) and not self._ignore.match(p, f.is_folder)
         ]
 
     def _download(self, request, buffer):
-        downloader = MediaIoBaseDownload(buffer, request)
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=self._chunk_size)
         done = False
         while done is False:
             try:
@@ -452,6 +1316,11 @@ class GoogleDriveFS(FileSystem):
                 raise
         return buffer
 
+    def _download_range(self, file_id, start, end):
+        request = self._drive.files().get_media(fileId=file_id)
+        request.headers["range"] = f"bytes={start}-{end}"
+        return request.execute()
+
     @suppresserror
     def read(self, path):
         file = self.search(path)
@@ -460,9 +1329,30 @@ class GoogleDriveFS(FileSystem):
 
         LOGGER.info(f"Downloading {file} at {path}")
 
+        # The content is streamed to the caller while it is being downloaded.
         request = self._drive.files().get_media(fileId=file._id)
-        stream = io.BytesIO()
-        self._download(request, stream)
+
+        def fetch(buffer):
+            self._download(request, buffer)
+
+        size = getattr(file, "size", None)
+        if (
+            self._download_workers > 1
+            and size
+            and size >= self._download_threshold
+            and file.md5
+        ):
+            return RangedDownload(
+                fetch,
+                lambda start, end: self._download_range(file._id, start, end),
+                size,
+                file.md5,
+                self._download_segment_size,
+                self._download_workers,
+            )
+
+        stream = DownloadStream(fetch)
+        stream.start()
 
         # TODO: This code should be fixed in order to support Google Docs
         #
@@ -482,9 +1372,6 @@ class GoogleDriveFS(FileSystem):
         #             if e.resp.status != 403:
         #                 raise
 
-        stream.flush()
-        stream.seek(0)
-
         return stream
 
     @suppresserror
@@ -517,8 +1404,31 @@ class GoogleDriveFS(FileSystem):
         parent = self.search(root)
         if not parent:
             raise RuntimeError("Invalid path")
-        for p in dirs:
-            parent = self.search(p) or makedir(p, parent)
+        with self._makedirs_lock:
+            for p in dirs:
+                parent = self.search(p) or makedir(p, parent)
+
+    @contextmanager
+    def batch(self):
+        # Metadata requests made by this thread within the context are sent in
+        # batches, and the state is updated as their responses come in.
+        if getattr(self._local, "batch", None) is not None:
+            yield  # Nested batches are part of the outer one
+            return
+
+        self._local.batch = MetadataBatch(self._drive, self._governor)
+        try:
+            yield
+            self._local.batch.flush()
+        finally:
+            self._local.batch = None
+
+    def _submit(self, request, callback):
+        batch = getattr(self._local, "batch", None)
+        if batch is None:
+            callback(request.execute())
+        else:
+            batch.add(request, callback)
 
     @suppresserror
     def remove(self, path):
@@ -526,34 +1436,166 @@ class GoogleDriveFS(FileSystem):
         if not file:
             return
 
-        self._drive.files().update(fileId=file._id, body={"trashed": True}).execute()
+        def trashed(_):
+            with STATE_LOCK:
+                self.state.remove(path)
+                if not file.is_folder and file.md5:
+                    self._trashed[file.md5] = (time(), file)
+                    self._trashed.move_to_end(file.md5)
+                    if len(self._trashed) > self.MAX_TRASHED:
+                        self._trashed.popitem(last=False)
+
+        self._submit(
+            self._drive.files().update(fileId=file._id, body={"trashed": True}),
+            trashed,
+        )
+
+    def _pop_trashed(self, md5):
+        with STATE_LOCK:
+            trashed_at, file = self._trashed.pop(md5, (None, None))
+        return file if file and time() - trashed_at < self.TRASHED_TTL else None
+
+    @suppresserror
+    def reuse(self, file, path):
+        # Content that is on Drive already is not uploaded again. A file that
+        # has been trashed by an earlier delta is restored and moved to the new
+        # path, e.g. when a local move is reported as a removal and, later on,
+        # an addition. Within the same delta, such pairs are moved rather than
+        # reused. Any other file with the same content is copied server-side.
+        # Existing files are overwritten by uploads to keep their revision
+        # history.
+        if file.is_folder or not file.md5 or self.search(path):
+            return False
+
+        folder, name = os.path.split(path)
+        parent = self.search(folder)
+        if not parent:
+            self.makedirs(folder)
+            parent = self.search(folder)
+
+        body = {"name": name, "modifiedTime": _to_drive_time(file.modified_date)}
+
+        trashed = self._pop_trashed(file.md5)
+        if trashed:
+            LOGGER.info(f"Restoring trashed {trashed} to {path}")
+            kwargs = {}
+            if parent._id not in trashed.parents:
+                kwargs["addParents"] = parent._id
+                kwargs["removeParents"] = ",".join(trashed.parents)
+            request = self._drive.files().update(
+                fileId=trashed._id,
+                body=dict(body, trashed=False),
+                fields=GoogleDriveFS.FILE_FIELDS,
+                **kwargs,
+            )
+        else:
+            with STATE_LOCK:
+                found = self.state.find(file.md5)
+            if not found:
+                return False
+            src, source = found
+            LOGGER.info(f"Copying {src} to {path} on Drive")
+            request = self._drive.files().copy(
+                fileId=source._id,
+                body=dict(body, parents=[parent._id]),
+                fields=GoogleDriveFS.FILE_FIELDS,
+            )
+
         with STATE_LOCK:
-            self.state.remove(path)
+            self.state.add(self._to_file(request.execute()), path)
+
+        return True
+
+    def _upload_status(self, request, uri):
+        # Ask the server how much of the upload at uri it has received, as per
+        # the resumable upload protocol. Returns the resource if the upload is
+        # complete. Otherwise, the request is set to carry on from the first
+        # byte that the server is missing, and None is returned.
+        resp, content = request.http.request(
+            uri,
+            method="PUT",
+            headers={
+                "Content-Length": "0",
+                "Content-Range": f"bytes */{request.resumable.size()}",
+            },
+        )
+        if resp.status in (200, 201):
+            return json.loads(content)
+        if resp.status != 308:
+            raise HttpError(resp, content, uri=uri)
+
+        received = resp.get("range", None)  # e.g. bytes=0-1048575
+        request.resumable_uri = uri
+        request.resumable_progress = (
+            int(received.rpartition("-")[2]) + 1 if received else 0
+        )
+        return None
+
+    def _upload(self, request, path, fingerprint):
+        # Drive the resumable upload one chunk at a time, recording the session
+        # URI as soon as it is known. If a session for the same content is on
+        # record, the upload resumes from where the server says it got to.
+        response = None
+        uri = self._uploads.get(path, fingerprint)
+        if uri:
+            LOGGER.info(f"Resuming upload of {path}")
+            try:
+                response = self._upload_status(request, uri)
+            except HttpError as e:
+                if e.resp.status not in (404, 410):
+                    raise
+                # The session has expired, so we start over.
+                LOGGER.warning(f"Upload session for {path} expired. Restarting.")
+                self._uploads.discard(path)
+                uri = None
+
+        while response is None:
+            status, response = request.next_chunk()
+
+            if request.resumable_uri != uri:
+                uri = request.resumable_uri
+                self._uploads.put(path, fingerprint, uri)
+
+            if status:
+                LOGGER.debug(
+                    f"Uploaded {status.resumable_progress}/{status.total_size} bytes "
+                    f"of {path}"
+                )
+
+        self._uploads.discard(path)
+
+        return response
 
     @suppresserror
     def write(self, stream, path, modified_date):
         if not stream:
             return
 
+        # Files that fit in a single chunk are uploaded in one request. Larger
+        # files are streamed from disk through a resumable upload.
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        resumable = size > self._chunk_size
+
+        media_body = MediaIoBaseUpload(
+            stream,
+            mimetype=mimetypes.guess_type(path)[0] or self.DEFAULT_MIMETYPE,
+            chunksize=self._chunk_size if resumable else -1,
+            resumable=resumable,
+        )
+
         current_file = self.search(path)
         if current_file:  # A file exists at this location
-            new_file = self._to_file(
-                self._drive.files()
-                .update(
-                    fileId=current_file._id,
-                    body={
-                        "name": os.path.basename(path),
-                        "modifiedTime": datetime.datetime.strftime(
-                            modified_date, "%Y-%m-%dT%H:%M:%S.%fZ"
-                        ),
-                    },
-                    media_body=MediaIoBaseUpload(
-                        stream,
-                        mimetype=mimetypes.guess_type(path)[0] or self.DEFAULT_MIMETYPE,
-                    ),
-                    fields=GoogleDriveFS.FILE_FIELDS,
-                )
-                .execute()
+            target = current_file._id
+            request = self._drive.files().update(
+                fileId=current_file._id,
+                body={
+                    "name": os.path.basename(path),
+                    "modifiedTime": _to_drive_time(modified_date),
+                },
+                media_body=media_body,
+                fields=GoogleDriveFS.FILE_FIELDS,
             )
         else:  # File does not exist, create it
             folder, name = os.path.split(path)
@@ -562,40 +1604,30 @@ class GoogleDriveFS(FileSystem):
                 self.makedirs(folder)
                 parent = self.search(folder)
 
-            new_file = self._to_file(
-                self._drive.files()
-                .create(
-                    body={
-                        "name": name,
-                        "modifiedTime": datetime.datetime.strftime(
-                            modified_date, "%Y-%m-%dT%H:%M:%S.%fZ"
-                        ),
-                        "parents": [parent._id],
-                    },
-                    media_body=MediaIoBaseUpload(
-                        stream,
-                        mimetype=mimetypes.guess_type(name)[0] or self.DEFAULT_MIMETYPE,
-                    ),
-                    fields=GoogleDriveFS.FILE_FIELDS,
-                )
-                .execute()
+            target = parent._id
+            request = self._drive.files().create(
+                body={
+                    "name": name,
+                    "modifiedTime": _to_drive_time(modified_date),
+                    "parents": [parent._id],
+                },
+                media_body=media_body,
+                fields=GoogleDriveFS.FILE_FIELDS,
             )
 
-        # Ensure that modified date matches
-        while new_file.modified_date != modified_date:
-            sleep(0.001)
-            new_file = self._to_file(
-                self._drive.files()
-                .update(
-                    fileId=new_file._id,
-                    body={
-                        "modifiedTime": datetime.datetime.strftime(
-                            modified_date, "%Y-%m-%dT%H:%M:%S.%fZ"
-                        )
-                    },
-                    fields=GoogleDriveFS.FILE_FIELDS,
-                )
-                .execute()
+        new_file = self._to_file(
+            self._upload(request, path, (target, size, modified_date))
+            if resumable
+            else request.execute()
+        )
+
+        # The modified time, rounded to the precision Drive keeps, is set by
+        # the upload request itself. The state records the time that Drive
+        # returns, so any difference shows up as a mismatch with the source.
+        if new_file.modified_date != _round_ms(modified_date):
+            LOGGER.warning(
+                f"Modified time of {path} on Drive is {new_file.modified_date} "
+                f"rather than {modified_date}"
             )
 
         with STATE_LOCK:
@@ -616,19 +1648,13 @@ class GoogleDriveFS(FileSystem):
         if not dst_dir:
             raise RuntimeError("Destination folder does not exist.")
 
+        body = {"name": tail, "parents": [dst_dir._id]}
+        if file.modified_date:  # Folders have none
+            body["modifiedTime"] = _to_drive_time(file.modified_date)
+
         copy = self._to_file(
             self._drive.files()
-            .copy(
-                fileId=file._id,
-                body={
-                    "name": tail,
-                    "modifiedTime": datetime.datetime.strftime(
-                        modified_date, "%Y-%m-%dT%H:%M:%S.%fZ"
-                    ),
-                    "parents": [dst_dir._id],
-                },
-                fields=GoogleDriveFS.FILE_FIELDS,
-            )
+            .copy(fileId=file._id, body=body, fields=GoogleDriveFS.FILE_FIELDS)
             .execute()
         )
 
@@ -647,27 +1673,26 @@ class GoogleDriveFS(FileSystem):
             self.makedirs(head)
             dst_dir = self.search(head)
 
-        dest_file = self._to_file(
-            self._drive.files()
-            .update(
+        def moved(response):
+            with STATE_LOCK:
+                state = self.state
+                state.remove(src)
+                state.add(self._to_file(response), dst)
+
+        body = {"name": tail}
+        if file.modified_date:  # Folders have none
+            body["modifiedTime"] = _to_drive_time(file.modified_date)
+
+        self._submit(
+            self._drive.files().update(
                 fileId=file._id,
-                body={
-                    "name": tail,
-                    "modifiedTime": datetime.datetime.strftime(
-                        file.modified_date, "%Y-%m-%dT%H:%M:%S.%fZ"
-                    ),
-                },
+                body=body,
                 addParents=dst_dir._id,
                 removeParents=",".join(file.parents),
                 fields=GoogleDriveFS.FILE_FIELDS,
-            )
-            .execute()
+            ),
+            moved,
         )
 
-        with STATE_LOCK:
-            state = self.state
-            state.remove(src)
-            state.add(dest_file, dst)
-
     def __repr__(self):
         return f"{type(self).__name__}({self._path(self._droot)})"
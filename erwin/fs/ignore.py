@@ -0,0 +1,167 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os.path
+import re
+
+from erwin.logging import LOGGER
+
+
+IGNORE_FILE = ".erwinignore"
+
+
+def _translate(pattern):
+    # Translate a gitignore-style pattern, without any leading ! or trailing /,
+    # into a regular expression that matches paths relative to the root.
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+
+    regex = "" if anchored else "(?:.*/)?"
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[":
+            j = pattern.find("]", i + 2)
+            if j < 0:
+                regex += re.escape(pattern[i])
+                i += 1
+                continue
+            cls = pattern[i + 1 : j].replace("\\", "\\\\")
+            if cls[0] == "!":
+                cls = "^" + cls[1:]
+            regex += f"[{cls}]"
+            i = j + 1
+        elif pattern[i] == "\\" and i + 1 < n:
+            regex += re.escape(pattern[i + 1])
+            i += 2
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+
+    return regex
+
+
+def _compile(rules):
+    # All the rules are compiled into a single regular expression. The
+    # alternatives are in reverse order so that the first one that matches is
+    # the last rule in the file, which is the one that decides, like in git.
+    if not rules:
+        return None, set()
+
+    alternatives = []
+    negated = set()
+    for i, (regex, negate) in reversed(list(enumerate(rules))):
+        alternatives.append(f"(?P<r{i}>{regex})")
+        if negate:
+            negated.add(f"r{i}")
+
+    return re.compile("|".join(alternatives)), negated
+
+
+class IgnoreRules:
+    def __init__(self, patterns=(), ignore_file=None):
+        self._ignore_file = ignore_file
+        self._set_patterns(patterns)
+
+    @classmethod
+    def from_file(cls, ignore_file):
+        rules = cls(ignore_file=ignore_file)
+        rules.reload()
+        return rules
+
+    @property
+    def ignore_file(self):
+        return self._ignore_file
+
+    def reload(self):
+        # The ignore file lives at the root and is never synchronised.
+        patterns = ["/" + os.path.basename(self._ignore_file)]
+        try:
+            with open(self._ignore_file, "r") as fi:
+                self._set_patterns(patterns + fi.read().splitlines())
+        except (FileNotFoundError, IOError):
+            self._set_patterns(patterns)
+            return
+
+        LOGGER.info(f"Ignore rules loaded from {self._ignore_file}")
+
+    def _set_patterns(self, patterns):
+        file_rules, dir_rules = [], []
+        for pattern in patterns:
+            pattern = pattern.rstrip("\n")
+            if not pattern.strip() or pattern.startswith("#"):
+                continue
+            if not pattern.endswith("\\ "):
+                pattern = pattern.rstrip()
+
+            negate = pattern.startswith("!")
+            if negate or pattern.startswith("\\!") or pattern.startswith("\\#"):
+                pattern = pattern[1:]
+
+            dir_only = pattern.endswith("/")
+            rule = (_translate(pattern.rstrip("/")), negate)
+
+            dir_rules.append(rule)
+            if not dir_only:
+                file_rules.append(rule)
+
+        # Replace the compiled rules in one go, so that they can be reloaded
+        # while other threads are matching paths.
+        self._compiled = _compile(file_rules), _compile(dir_rules)
+
+    def __bool__(self):
+        return self._compiled[1][0] is not None
+
+    def _match(self, path, is_dir):
+        regex, negated = self._compiled[is_dir]
+        if regex is None:
+            return False
+
+        m = regex.fullmatch(path)
+        return bool(m) and m.lastgroup not in negated
+
+    def match(self, path, is_dir=False, ancestors=True):
+        # A path is ignored if any of its ancestors is. The check on the
+        # ancestors can be skipped when they are known not to be ignored, like
+        # when walking a tree top-down.
+        if not self:
+            return False
+
+        if ancestors:
+            head = os.path.dirname(path)
+            while head:
+                if self._match(head, True):
+                    return True
+                head = os.path.dirname(head)
+
+        return self._match(path, is_dir)
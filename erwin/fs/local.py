@@ -20,26 +20,39 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from copy import deepcopy
 from datetime import datetime
+import errno
 import hashlib
 import os
 from queue import Queue
-from time import time
+from stat import S_ISDIR, S_ISREG
+from threading import Condition, Lock, RLock, Thread
+from time import monotonic, time
+from uuid import uuid4
 
-from shutil import copy, copyfileobj, move, rmtree
+from shutil import copyfileobj, copymode, move, rmtree
 
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 from watchdog.observers.inotify_buffer import InotifyBuffer
 
+try:
+    import fcntl
+except ImportError:  # Not a POSIX platform
+    fcntl = None
+
 
 # Monkey-patch watchdog to reduce enqueuing delay
 InotifyBuffer.delay = 0
 
 
-from erwin.flow import atomic
+from erwin.flow import _overlap, atomic, bounded_map, PATH_LOCK
 from erwin.fs import Delta, File, FileSystem, State
+from erwin.fs.cache import HashCache, stat_key
+from erwin.fs.ignore import IgnoreRules
 from erwin.logging import LOGGER
 
 
@@ -51,7 +64,128 @@ def _md5(path):
     return hash_md5.hexdigest()
 
 
+# Prefix and suffix of the hidden temporary files used for downloads
+TEMP_PREFIX = ".erwin-"
+TEMP_SUFFIX = ".part"
+
+
+def _is_temp(path):
+    name = os.path.basename(path)
+    return name.startswith(TEMP_PREFIX) and name.endswith(TEMP_SUFFIX)
+
+
+# ioctl request to share the extents of a file with another one (reflink)
+FICLONE = 0x40049409
+
+# Errors that signal that a kernel copy mechanism is not available for the
+# given files, in which case the next one is tried.
+_UNSUPPORTED = {
+    errno.EBADF,
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSUP,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EXDEV,
+}
+
+
+def _kernel_copy(fin, fout):
+    # Copy the content of the regular file fin to fout without moving any data
+    # through user space. Reflinks are tried first, as they copy no data at
+    # all on file systems like btrfs and XFS, then copy_file_range and
+    # sendfile. Returns False if none of them can be used.
+    ifd, ofd = fin.fileno(), fout.fileno()
+
+    if fcntl:
+        try:
+            fcntl.ioctl(ofd, FICLONE, ifd)
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+
+    size = os.fstat(ifd).st_size
+    copy_file_range = getattr(os, "copy_file_range", None)
+    sendfile = getattr(os, "sendfile", None)
+
+    for kcopy in [
+        copy_file_range and (lambda n, o: copy_file_range(ifd, ofd, n, o, o)),
+        sendfile and (lambda n, o: sendfile(ofd, ifd, o, n)),
+    ]:
+        if not kcopy:
+            continue
+
+        offset = 0
+        try:
+            while offset < size:
+                copied = kcopy(min(size - offset, 1 << 30), offset)
+                if not copied:
+                    break  # The source has shrunk
+                offset += copied
+            os.ftruncate(ofd, offset)
+            return True
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or offset:
+                raise
+
+    return False
+
+
+def _copy_md5(fin, fout, chunk_size=1 << 20):
+    # Copy the content of fin to fout and return its MD5 hash, thus saving a
+    # second read of the data.
+    hash_md5 = hashlib.md5()
+    for chunk in iter(lambda: fin.read(chunk_size), b""):
+        hash_md5.update(chunk)
+        fout.write(chunk)
+    return hash_md5.hexdigest()
+
+
+def _walk(root, skip=None):
+    # Top-down walk of the tree at root that yields the absolute path of every
+    # entry together with its stat result, so that each entry is stat'ed
+    # exactly once. Like os.walk, symbolic links to folders are not followed.
+    # Entries for which skip(path, is_dir) is true are pruned.
+    try:
+        with os.scandir(root) as it:
+            entries = list(it)
+    except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+        LOGGER.warning(f"Cannot scan local folder {root}. Reason: {e}")
+        return
+
+    subdirs = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue  # Removed while walking or broken link
+
+        is_dir = S_ISDIR(stat.st_mode)
+        if skip and skip(entry.path, is_dir):
+            continue
+
+        yield entry.path, stat
+
+        if is_dir and not entry.is_symlink():
+            subdirs.append(entry.path)
+
+    for subdir in subdirs:
+        yield from _walk(subdir, skip)
+
+
 class LocalFile(File):
+    @classmethod
+    def from_stat(cls, stat, md5=None):
+        is_folder = S_ISDIR(stat.st_mode)
+        return cls(
+            md5=md5 if not is_folder else stat.st_ino,
+            is_folder=is_folder,
+            modified_date=datetime.fromtimestamp(round(stat.st_mtime, 3))
+            if not is_folder
+            else None,
+        )
+
     @property
     def id(self):
         return self.md5, self.modified_date
@@ -61,26 +195,161 @@ class LocalFSState(State):
     pass
 
 
+class OperationRegistry:
+    # Registry of the operations performed by erwin on the local FS. The
+    # events that these operations generate are tagged as echoes for a while,
+    # so that they can be dropped before they reach the collector queue.
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = Lock()
+        self._ops = {}  # (kind, path) -> (dst, expiry)
+
+    def register(self, kind, path, dst=None):
+        with self._lock:
+            self._ops[(kind, path)] = (dst, monotonic() + self._ttl)
+
+    def _purge(self):
+        now = monotonic()
+        for op in [op for op, (_, expiry) in self._ops.items() if expiry < now]:
+            del self._ops[op]
+
+    def is_echo(self, kind, path, dst=None):
+        # The event for a path is an echo of an operation on the path itself or
+        # on any of its ancestors, e.g. a rmtree or the move of a folder.
+        with self._lock:
+            self._purge()
+
+            head = path
+            while head:
+                try:
+                    op_dst, _ = self._ops[(kind, head)]
+                    if dst is None or dst == op_dst + path[len(head) :]:
+                        return True
+                except KeyError:
+                    pass
+                head = os.path.dirname(head)
+
+            return False
+
+
 class LocalFSEventHandler(FileSystemEventHandler):
-    def __init__(self, fs):
+    ADDED = "added"
+    MOVED = "moved"
+    REMOVED = "removed"
+
+    def __init__(self, fs, window=0.5):
         super().__init__()
 
         self._fs = fs
         self._state = fs.state
 
-    @atomic()
+        # Events are coalesced per path and only flushed to the FS queue, as a
+        # single delta, once a path has been quiescent for the given window.
+        self._window = window
+        self._pending = OrderedDict()  # path -> (kind, deadline)
+        self._pending_cond = Condition()
+        self._flush_lock = RLock()
+
+        flusher = Thread(name="Coalesce", target=self._flusher)
+        flusher.daemon = True
+        flusher.start()
+
+    def _push(self, path, kind):
+        with self._pending_cond:
+            prev = self._pending.pop(path, None)
+            if kind == self.REMOVED and prev and prev[0] == self.ADDED:
+                if self._state[path] is None:
+                    return  # Created and removed within the window.
+
+            self._pending[path] = (kind, monotonic() + self._window)
+            self._pending_cond.notify()
+
+    def _pop_pending(self, flush_all=False):
+        now = monotonic()
+        batch = []
+        while self._pending:
+            path, (kind, deadline) = next(iter(self._pending.items()))
+            if not flush_all and deadline > now:
+                break
+            del self._pending[path]
+            batch.append((path, kind))
+        return batch
+
+    def _flusher(self):
+        while True:
+            with self._pending_cond:
+                while not self._pending:
+                    self._pending_cond.wait()
+
+                # Pending events are ordered by deadline.
+                _, (_, deadline) = next(iter(self._pending.items()))
+                delay = deadline - monotonic()
+                if delay > 0:
+                    self._pending_cond.wait(delay)
+                    continue
+
+            with self._flush_lock:
+                with self._pending_cond:
+                    batch = self._pop_pending()
+                self._flush(batch)
+
+    @atomic(PATH_LOCK, paths=lambda _, batch: [p for p, _ in batch])
+    def _flush(self, batch):
+        # Files are hashed only now that they are stable.
+        ops = self._fs.operations
+        added, removed = [], []
+        for path, kind in batch:
+            if kind == self.ADDED:
+                try:
+                    file = self._fs._to_file(self._fs._abs_path(path))
+                    if ops.is_echo(kind, path) and file & self._state[path]:
+                        continue
+                    self._state.add(file, path)
+                    added.append((file, path))
+                    continue
+                except FileNotFoundError:
+                    if self._state[path] is None:
+                        continue
+
+            elif ops.is_echo(kind, path) and self._state[path] is None:
+                continue
+
+            file = self._state[path]
+            if file and file.is_folder:
+                for p in [p for p, _ in self._state if p.startswith(path + "/")]:
+                    self._state.remove(p)
+            self._state.remove(path)
+            self._fs.hash_cache.discard(path)
+            removed.append(path)
+
+        delta = Delta(
+            added=sorted(added, key=lambda x: x[1]),
+            removed=sorted(removed, reverse=True),
+        )
+        if delta:
+            self._fs._queue.put(delta)
+
+    # Wait for any local operation on the paths of the event to complete, so
+    # that it is registered by the time the event is handled.
+    @atomic(
+        PATH_LOCK,
+        paths=lambda self, event: [
+            self._fs._rel_path(p)
+            for p in (event.src_path, getattr(event, "dest_path", None))
+            if p
+        ],
+    )
     def on_any_event(self, event):
         pass
 
     def on_created(self, event):
-        abs_path = event.src_path
-
-        file = self._fs._to_file(abs_path)
-        path = self._fs._rel_path(abs_path)
-
-        self._state.add(file, path)
+        if event.src_path == self._fs.ignore.ignore_file:
+            self._fs.ignore.reload()
 
-        self._fs._queue.put(Delta(added=[(file, path)]))
+        if self._fs._skip(event.src_path, event.is_directory):
+            return
+        self._push(self._fs._rel_path(event.src_path), self.ADDED)
 
     def on_modified(self, event):
         if event.is_directory:
@@ -88,27 +357,117 @@ class LocalFSEventHandler(FileSystemEventHandler):
         self.on_created(event)
 
     def on_deleted(self, event):
-        path = self._fs._rel_path(event.src_path)
-        self._state.remove(path)
-        self._fs._queue.put(Delta(removed=[path]))
+        if event.src_path == self._fs.ignore.ignore_file:
+            self._fs.ignore.reload()
+
+        if self._fs._skip(event.src_path, event.is_directory):
+            return
+        self._push(self._fs._rel_path(event.src_path), self.REMOVED)
 
     def on_moved(self, event):
         src = self._fs._rel_path(event.src_path)
         dst = self._fs._rel_path(event.dest_path)
-        self._state.move(src, dst)
 
-        self._fs._queue.put(Delta(moved=[(src, dst)]))
+        if self._fs.operations.is_echo(self.MOVED, src, dst):
+            return
+
+        # Moves from and to skipped paths, like ignored paths and temporary
+        # files, are just additions and removals respectively.
+        src_skipped = self._fs._skip(event.src_path, event.is_directory)
+        dst_skipped = self._fs._skip(event.dest_path, event.is_directory)
+        if src_skipped or dst_skipped:
+            if not dst_skipped:
+                self._push(dst, self.ADDED)
+            elif not src_skipped:
+                self._push(src, self.REMOVED)
+            return
+
+        with self._flush_lock:
+            with self._pending_cond:
+                # Pending changes within the source (e.g. a file that is first
+                # written to a temporary location and then renamed) are carried
+                # over to the destination.
+                carried = set()
+                for p in [
+                    p for p in self._pending if p == src or p.startswith(src + "/")
+                ]:
+                    kind, _ = self._pending.pop(p)
+                    p = dst + p[len(src) :]
+                    self._pending.pop(p, None)
+                    self._pending[p] = (kind, monotonic() + self._window)
+                    carried.add(p)
+
+                if self._state[src] is None:
+                    # With an unknown source and no pending changes, the
+                    # destination is new content, as in the case of the
+                    # temporary files used by LocalFS.write.
+                    if not carried:
+                        self._pending.pop(dst, None)
+                        self._pending[dst] = (self.ADDED, monotonic() + self._window)
+
+                    self._pending_cond.notify()
+                    return
+
+                # Moves of known paths are ordered after the pending events on
+                # the paths they involve, e.g. the removal of a file that the
+                # move replaces. The events carried over to the destination and
+                # those on unrelated paths are left to settle.
+                batch = [
+                    (p, kind)
+                    for p, (kind, _) in self._pending.items()
+                    if p not in carried and (_overlap(p, src) or _overlap(p, dst))
+                ]
+                for path, _ in batch:
+                    del self._pending[path]
+
+            self._flush(batch)
+            self._state.move(src, dst)
+
+            # The events for the content of a folder are echoes of its move.
+            self._fs.operations.register(self.MOVED, src, dst)
+
+            self._fs._queue.put(Delta(moved=[(src, dst)]))
 
 
 class LocalFS(FileSystem):
-    def __init__(self, root):
+    # Time, in seconds after the event window, within which events caused by
+    # operations performed by erwin are treated as echoes.
+    ECHO_TTL = 5
+
+    # How files are created from content that is in the local copy already.
+    REUSE_MODES = ("copy", "hardlink", "none")
+
+    def __init__(
+        self,
+        root,
+        hash_cache=None,
+        hash_cache_size=1 << 20,
+        hash_workers=None,
+        hash_processes=False,
+        event_window=0.5,
+        fsync=False,
+        reuse_mode="copy",
+        ignore=None,
+    ):
         abs_root = os.path.abspath(root)
         os.makedirs(abs_root, exist_ok=True)
         super().__init__(abs_root)
 
+        self._hash_cache = HashCache.load(hash_cache, hash_cache_size)
+        self._hash_workers = hash_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._hash_processes = hash_processes
+        self._hash_pool = None
+        self._ops = OperationRegistry(ttl=event_window + self.ECHO_TTL)
+        self._fsync = fsync
+        if reuse_mode not in self.REUSE_MODES:
+            raise ValueError(f"Invalid reuse mode: {reuse_mode}")
+        self._reuse_mode = reuse_mode
+        self._ignore = ignore if ignore is not None else IgnoreRules()
         self._state = {}
         self._watchdog = Observer()
-        self._watchdog.schedule(LocalFSEventHandler(self), abs_root, recursive=True)
+        self._watchdog.schedule(
+            LocalFSEventHandler(self, event_window), abs_root, recursive=True
+        )
         self._queue = Queue()
 
     def _abs_path(self, path):
@@ -117,15 +476,65 @@ class LocalFS(FileSystem):
     def _rel_path(self, path):
         return os.path.relpath(path, start=self.root)
 
-    def _to_file(self, abs_path):
-        is_folder = os.path.isdir(abs_path)
+    @property
+    def hash_cache(self):
+        return self._hash_cache
+
+    @property
+    def operations(self):
+        return self._ops
+
+    @property
+    def ignore(self):
+        return self._ignore
+
+    def _skip(self, abs_path, is_dir, ancestors=True):
+        return _is_temp(abs_path) or self._ignore.match(
+            self._rel_path(abs_path), is_dir, ancestors
+        )
+
+    def _hash(self, abs_path, stat):
+        key = stat_key(stat)
         rel_path = self._rel_path(abs_path)
-        return LocalFile(
-            md5=_md5(abs_path) if not is_folder else os.stat(abs_path).st_ino,
-            is_folder=is_folder,
-            modified_date=datetime.fromtimestamp(round(os.path.getmtime(abs_path), 3))
-            if not is_folder
-            else None,
+
+        md5 = self._hash_cache.get(key, rel_path)
+        if md5 is None:
+            md5 = (
+                self._hash_pool.submit(_md5, abs_path).result()
+                if self._hash_pool
+                else _md5(abs_path)
+            )
+            # Do not cache the hash of a file that changed while being read.
+            if stat_key(os.stat(abs_path)) == key:
+                self._hash_cache.put(key, rel_path, md5)
+
+        return md5
+
+    def _copy(self, fin, fout):
+        # Copy fin to fout and return the MD5 hash of the content. Local files
+        # whose hash is known already are copied in kernel space, whereas
+        # streams that can write to a file directly, like ranged downloads, are
+        # left to do so.
+        write_to = getattr(fin, "write_to", None)
+        if write_to:
+            return write_to(fout)
+
+        try:
+            stat = os.fstat(fin.fileno())
+        except (AttributeError, OSError):
+            stat = None  # Not a file, e.g. a download buffer
+
+        if stat and S_ISREG(stat.st_mode):
+            md5 = self._hash_cache.get(stat_key(stat))
+            if md5 and _kernel_copy(fin, fout):
+                return md5
+
+        return _copy_md5(fin, fout)
+
+    def _to_file(self, abs_path, stat=None):
+        stat = stat or os.stat(abs_path)
+        return LocalFile.from_stat(
+            stat, self._hash(abs_path, stat) if not S_ISDIR(stat.st_mode) else None
         )
 
     @property
@@ -134,6 +543,9 @@ class LocalFS(FileSystem):
             return self._state
 
         self._state = LocalFSState.from_file_list(self._list())
+        self._state.ignore = self._ignore
+        self._hash_cache.prune({p for p, _ in self._state})
+        self._hash_cache.save()
         self._watchdog.start()
 
         return self._state
@@ -142,11 +554,20 @@ class LocalFS(FileSystem):
         while True:
             yield self._queue.get()
 
-    @atomic()
+    @atomic(PATH_LOCK, paths=lambda _, path: [path])
     def makedirs(self, path):
+        self._makedirs(path)
+
+    def _makedirs(self, path):
         LOGGER.debug(f"Creating local directory {path}")
         os.makedirs(self._abs_path(path), exist_ok=True)
 
+        state = self.state
+        while path and not state[path]:
+            state.add(self._to_file(self._abs_path(path)), path)
+            self._ops.register(LocalFSEventHandler.ADDED, path)
+            path = os.path.dirname(path)
+
     def read(self, path):
         try:
             return open(self._abs_path(path), "rb")
@@ -158,16 +579,34 @@ class LocalFS(FileSystem):
         return self.state[path]
 
     def _list(self):
-        return [
-            (self._rel_path(os.path.join(dp, f)), self._to_file(os.path.join(dp, f)))
-            for dp, dn, filenames in os.walk(self.root)
-            for f in dn + filenames
-        ]
+        def to_file(entry):
+            abs_path, stat = entry
+            return self._rel_path(abs_path), self._to_file(abs_path, stat)
+
+        # Ignored subtrees are pruned from the walk, together with any
+        # temporary file left behind by an interrupted download.
+        entries = _walk(self.root, lambda p, d: self._skip(p, d, ancestors=False))
+
+        # Hashing is driven by a pool of threads, as hashlib releases the GIL.
+        # Optionally, the actual hashing is offloaded to a pool of processes.
+        with ThreadPoolExecutor(
+            max_workers=self._hash_workers, thread_name_prefix="Hash"
+        ) as threads:
+            if self._hash_processes:
+                self._hash_pool = ProcessPoolExecutor(max_workers=self._hash_workers)
+            try:
+                return list(
+                    bounded_map(threads, to_file, entries, self._hash_workers * 4)
+                )
+            finally:
+                if self._hash_pool:
+                    self._hash_pool.shutdown()
+                    self._hash_pool = None
 
     def list(self):
         return iter(self.state)
 
-    @atomic()
+    @atomic(PATH_LOCK, paths=lambda _, path: [path])
     def remove(self, path):
         LOGGER.debug(f"Removing local file at {path}")
         abs_path = self._abs_path(path)
@@ -178,28 +617,139 @@ class LocalFS(FileSystem):
         except FileNotFoundError:
             pass
 
-    @atomic()
+        state = self.state
+        for p in [p for p, _ in state if p.startswith(path + "/")]:
+            state.remove(p)
+        state.remove(path)
+        self._ops.register(LocalFSEventHandler.REMOVED, path)
+
+    @atomic(PATH_LOCK, paths=lambda _, src, dst: [src, dst])
     def move(self, src: str, dst: str):
         try:
             LOGGER.debug(f"Moving local file {src} to {dst}")
             move(self._abs_path(src), self._abs_path(dst))
         except FileNotFoundError:
-            pass
+            return
+
+        self.state.move(src, dst)
+        self._ops.register(LocalFSEventHandler.MOVED, src, dst)
+
+    def _temp_path(self, abs_path):
+        head, tail = os.path.split(abs_path)
+        return os.path.join(head, f"{TEMP_PREFIX}{tail}.{uuid4().hex[:8]}{TEMP_SUFFIX}")
+
+    def reuse(self, file, path):
+        # Content that is in the local copy already, e.g. that of a file that
+        # has been copied on Drive, is copied from the local file rather than
+        # downloaded.
+        if self._reuse_mode == "none" or file.is_folder or not file.md5:
+            return False
+
+        found = self.state.find(file.md5)
+        if not found:
+            return False
+        src, _ = found
+
+        return self._reuse(src, file, path)
+
+    @atomic(PATH_LOCK, paths=lambda _, src, file, path: [src, path])
+    def _reuse(self, src, file, path):
+        abs_src = self._abs_path(src)
+        try:
+            fin = open(abs_src, "rb")
+        except (FileNotFoundError, IOError):
+            return False
+
+        # The source might have changed since it was indexed.
+        stat = os.fstat(fin.fileno())
+        if self._hash(abs_src, stat) != file.md5:
+            fin.close()
+            return False
+
+        LOGGER.info(f"Reusing local file {src} for {path}")
+
+        # Hard links share the modified time too, so they are only used when
+        # that matches as well.
+        if self._reuse_mode == "hardlink" and round(stat.st_mtime, 3) == round(
+            datetime.timestamp(file.modified_date), 3
+        ):
+            fin.close()
+            try:
+                self._link(abs_src, path, file.md5)
+                return True
+            except OSError as e:
+                LOGGER.warning(f"Cannot link {src} to {path}. Reason: {e}")
+                fin = open(abs_src, "rb")
+
+        self.write(fin, path, file.modified_date)
+
+        return True
+
+    def _link(self, abs_src, path, md5):
+        abs_path = self._abs_path(path)
 
-    @atomic()
+        folder = os.path.dirname(path)
+        if not self.search(folder):
+            self._makedirs(folder)
+
+        tmp_path = self._temp_path(abs_path)
+        os.link(abs_src, tmp_path)
+        try:
+            os.replace(tmp_path, abs_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        stat = os.stat(abs_path)
+        self._hash_cache.put(stat_key(stat), path, md5)
+        self.state.add(LocalFile.from_stat(stat, md5), path)
+        self._ops.register(LocalFSEventHandler.ADDED, path)
+
+    @atomic(PATH_LOCK, paths=lambda _, stream, path, modified_date: [path])
     def write(self, stream, path, modified_date):
         abs_path = self._abs_path(path)
 
         folder = os.path.dirname(path)
         if not self.search(folder):
-            self.makedirs(folder)
+            self._makedirs(folder)
 
-        with open(abs_path, "wb") as fout:
-            copyfileobj(stream, fout)
+        # Write to a temporary file first and then rename it into place, so
+        # that the file at path is never seen partially written.
+        head, _ = os.path.split(abs_path)
+        tmp_path = self._temp_path(abs_path)
+        try:
+            with open(tmp_path, "xb") as fout:
+                md5 = self._copy(stream, fout)
+                if self._fsync:
+                    fout.flush()
+                    os.fsync(fout.fileno())
+
+            mtime = datetime.timestamp(modified_date)
+            os.utime(tmp_path, (mtime, mtime))
+
+            os.replace(tmp_path, abs_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
             stream.close()
 
-        mtime = datetime.timestamp(modified_date)
-        os.utime(abs_path, (mtime, mtime))
+        if self._fsync:
+            dir_fd = os.open(head, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        # Register the new file straight away. The hash cache entry spares the
+        # event handler from reading the file we have just written again.
+        stat = os.stat(abs_path)
+        self._hash_cache.put(stat_key(stat), path, md5)
+        self.state.add(LocalFile.from_stat(stat, md5), path)
+        self._ops.register(LocalFSEventHandler.ADDED, path)
 
     def conflict(self, path: str) -> str:
         head, tail = os.path.split(path)
@@ -207,12 +757,24 @@ class LocalFS(FileSystem):
             head, f"conflict_{hex(int(time())).replace('0x', '')}_{tail}"
         )
 
-    @atomic()
+    @atomic(PATH_LOCK, paths=lambda _, src, dst: [src, dst])
     def copy(self, src: str, dst: str):
+        abs_src, abs_dst = self._abs_path(src), self._abs_path(dst)
         try:
-            copy(self._abs_path(src), self._abs_path(dst))
+            with open(abs_src, "rb") as fin, open(abs_dst, "wb") as fout:
+                # The copy has the same hash as the source, which is most
+                # likely in the hash cache already.
+                md5 = self._hash(abs_src, os.fstat(fin.fileno()))
+                if not _kernel_copy(fin, fout):
+                    copyfileobj(fin, fout)
+            copymode(abs_src, abs_dst)
         except FileNotFoundError:
-            pass
+            return
+
+        stat = os.stat(abs_dst)
+        self._hash_cache.put(stat_key(stat), dst, md5)
+        self.state.add(LocalFile.from_stat(stat, md5), dst)
+        self._ops.register(LocalFSEventHandler.ADDED, dst)
 
     def __del__(self):
         self._watchdog.stop()
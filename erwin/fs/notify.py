@@ -0,0 +1,99 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Event, Thread
+
+from erwin.logging import LOGGER
+
+
+# Interval between polls that drops to the minimum as soon as there is some
+# activity and grows geometrically up to the maximum while there is none. A
+# trigger, e.g. from a push notification, cuts the current wait short.
+class PollScheduler:
+    def __init__(self, min_interval=1, max_interval=60, ratio=1.618):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.ratio = ratio
+
+        self._interval = min_interval
+        self._triggered = Event()
+
+    @property
+    def interval(self):
+        return self._interval
+
+    def activity(self):
+        self._interval = self.min_interval
+
+    def idle(self):
+        self._interval = min(self._interval * self.ratio, self.max_interval)
+
+    def trigger(self):
+        self._triggered.set()
+
+    def wait(self):
+        # Returns True if the wait has been cut short by a trigger.
+        triggered = self._triggered.wait(self._interval)
+        self._triggered.clear()
+        return triggered
+
+
+# Local HTTP endpoint for push notifications. The headers of the notifications
+# that carry the expected channel token are passed to the callback.
+class WebhookListener:
+    def __init__(self, callback, token, host="127.0.0.1", port=0):
+        self.token = token
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                if length:
+                    self.rfile.read(length)
+
+                valid = self.headers.get("X-Goog-Channel-Token", None) == token
+                self.send_response(200 if valid else 403)
+                self.end_headers()
+
+                if valid:
+                    callback(self.headers)
+
+            def log_message(self, format, *args):
+                LOGGER.trace(f"Webhook: {format % args}")
+
+        self._server = HTTPServer((host, port), Handler)
+        self._thread = Thread(
+            target=self._server.serve_forever, name="Webhook", daemon=True
+        )
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+        LOGGER.info(f"Listening for push notifications on port {self.port}")
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -21,6 +21,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from copy import deepcopy
+import os.path
+
 from erwin.fs import Delta, File, FileSystem, State
 
 
@@ -46,7 +48,8 @@ class MockFileSystem(FileSystem):
     def __init__(self, root):
         super().__init__(root)
 
-        self._state = TestState()
+        self._state = State()
+        self.log = []
 
     @property
     def state(self):
@@ -56,6 +59,8 @@ class MockFileSystem(FileSystem):
         return self.state[path]
 
     def write(self, stream, path, modified_date):
+        assert not os.path.dirname(path) or self.state[os.path.dirname(path)]
+        self.log.append(path)
         self.state[path] = stream
 
     def list(self):
@@ -65,7 +70,22 @@ class MockFileSystem(FileSystem):
         return self.state[path]
 
     def makedirs(self, path):
+        self.log.append(path)
         self.state[path] = MockDir(path)
 
     def remove(self, path):
+        self.log.append(path)
         self.state.remove(path)
+
+    def move(self, src, dst):
+        self.log.append(src)
+        self.state.move(src, dst)
+
+    def copy(self, src, dst):
+        self.state[dst] = self.state[src]
+
+    def get_changes(self):
+        return iter([])
+
+    def conflict(self, path):
+        return path + ".conflict"
@@ -0,0 +1,70 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+from erwin.fs.cache import HashCache
+
+
+def test_hash_cache(tmp_path):
+    cache_file = str(tmp_path / "hashes.pickle")
+    cache = HashCache.load(cache_file, max_entries=2)
+
+    cache.put((1, 1, 10, 100), "a", "md5a")
+    cache.put((1, 2, 10, 100), "b", "md5b")
+
+    # Moved files hit the cache, modified files do not
+    assert cache.get((1, 1, 10, 100), "c") == "md5a"
+    assert cache.get((1, 2, 10, 200), "b") is None
+
+    # Least recently used entries are evicted first
+    cache.put((1, 3, 10, 100), "d", "md5d")
+    assert (1, 2, 10, 100) not in cache
+    assert len(cache) == 2
+
+    cache.prune({"c"})
+    cache.save()
+
+    cache = HashCache.load(cache_file)
+    assert len(cache) == 1
+    assert cache.get((1, 1, 10, 100), "c") == "md5a"
+
+
+def test_hash_cache_corrupt(tmp_path):
+    cache_file = str(tmp_path / "hashes.pickle")
+    cache = HashCache.load(cache_file)
+    for i in range(100):
+        cache.put((1, i, 10, 100), f"f{i}", f"md5{i}")
+    cache.save()
+
+    # A truncated cache, e.g. from an interrupted save, is thrown away
+    with open(cache_file, "rb") as fi:
+        content = fi.read()
+    with open(cache_file, "wb") as fo:
+        fo.write(content[: len(content) // 2])
+
+    assert len(HashCache.load(cache_file)) == 0
+
+    # Saves do not leave the temporary file behind
+    cache.save()
+    assert os.listdir(str(tmp_path)) == ["hashes.pickle"]
+    assert len(HashCache.load(cache_file)) == 100
@@ -0,0 +1,144 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from erwin.fs import Delta, State
+
+from test.fs import MockFile, MockFileSystem
+
+
+def test_delta_apply_parallel():
+    source, dest = MockFileSystem("/"), MockFileSystem("/")
+
+    for path in ["a", "a/b", "a/b/c", "d"]:
+        source.makedirs(path)
+    for i in range(32):
+        for folder in ["a", "a/b", "a/b/c", "d"]:
+            source.write(MockFile(f"{folder}{i}"), f"{folder}/f{i}", None)
+
+    delta = source.state - State()
+    delta.apply((source, State()), (dest, State()), workers=8)
+
+    assert {p for p, _ in dest.state} == {p for p, _ in source.state}
+
+    # Folders are created before their content
+    for i, path in enumerate(dest.log):
+        head = path.rpartition("/")[0]
+        assert not head or head in dest.log[:i]
+
+
+class MockReuseFileSystem(MockFileSystem):
+    def read(self, path):
+        raise AssertionError(f"{path} should have been reused")
+
+    def reuse(self, file, path):
+        found = self.state.find(file.md5)
+        if not found:
+            return False
+        self.log.append(path)
+        self.state[path] = found[1]
+        return True
+
+
+def test_delta_apply_reuse():
+    source, dest = MockReuseFileSystem("/"), MockReuseFileSystem("/")
+
+    source.write(MockFile(1), "a", None)
+    source.write(MockFile(1), "b", None)
+    dest.write(MockFile(1), "a", None)
+
+    source_state, dest_state = State(), State()
+    source_state.add(source.state["a"], "a")
+    dest_state.add(dest.state["a"], "a")
+
+    delta = source.state - source_state
+    delta.apply((source, source_state), (dest, dest_state))
+
+    assert dest.log == ["a", "b"]
+    assert dest.state["b"] == source.state["b"]
+
+
+def test_delta_apply_removed_reuse():
+    source, dest = MockReuseFileSystem("/"), MockReuseFileSystem("/")
+    source_state, dest_state = State(), State()
+    for fs, state in [(source, source_state), (dest, dest_state)]:
+        fs.state["a"] = state["a"] = MockFile(1)
+        fs.state["c"] = state["c"] = MockFile(2)
+
+    # A move reported as a removal and an addition, next to a copy of the
+    # removed content
+    file = source.state["a"]
+    source.remove("a")
+    source.state["b"] = source.state["d"] = file
+    delta = Delta([(file, "b"), (file, "d")], [], ["a"])
+    delta.apply((source, source_state), (dest, dest_state))
+
+    # The removed file is moved once, the copy is reused
+    assert sorted(dest.log) == ["a", "a", "d"]
+    assert dest.state["a"] is None and dest_state["a"] is None
+    assert dest.state["b"] == file and dest_state["b"] == file
+    assert dest.state["d"] == file and dest_state["d"] == file
+
+
+class MockLossyFileSystem(MockFileSystem):
+    def write(self, stream, path, modified_date):
+        self.log.append(path)  # The write never shows up in the state
+
+
+def test_delta_apply_timeout():
+    source, dest = MockFileSystem("/"), MockLossyFileSystem("/")
+
+    source.write(MockFile(1), "a", None)
+    source.write(MockFile(2), "b", None)
+    dest.state["b"] = MockFile(2)
+
+    source_state, dest_state = State(), State()
+    delta = source.state - source_state
+    delta.apply((source, source_state), (dest, dest_state), timeout=0.01)
+
+    # Changes that time out are left out of the states
+    assert dest.log == ["a"]
+    assert source_state["a"] is None and dest_state["a"] is None
+    assert source_state["b"] is not None and dest_state["b"] is not None
+
+
+class MockStuckFileSystem(MockFileSystem):
+    def move(self, src, dst):
+        if src != "stuck":
+            super().move(src, dst)
+
+
+def test_delta_apply_move_timeout():
+    source, dest = MockFileSystem("/"), MockStuckFileSystem("/")
+    source_state, dest_state = State(), State()
+    for i, path in enumerate(["a", "stuck"]):
+        for fs, state in [(source, source_state), (dest, dest_state)]:
+            fs.state[path] = state[path] = MockFile(i)
+
+    source.move("a", "b")
+    source.move("stuck", "c")
+    delta = source.state - source_state
+    delta.apply((source, source_state), (dest, dest_state), timeout=0.01)
+
+    # Moves that time out are recorded in neither state
+    assert source_state["b"] is not None and dest_state["b"] is not None
+    assert source_state["stuck"] is not None and dest_state["stuck"] is not None
+    assert source_state["c"] is None and dest_state["c"] is None
@@ -0,0 +1,504 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import hashlib
+import io
+import os
+from threading import Event, local
+from types import SimpleNamespace
+
+from googleapiclient.errors import HttpError
+import httplib2
+import pytest
+
+from erwin.fs.drive import (
+    _compact,
+    _expand,
+    _order_changes,
+    _to_drive_time,
+    CONNECTED,
+    GoogleDriveFS,
+    GoogleDriveFSState,
+    HttpPool,
+    DownloadStream,
+    MetadataBatch,
+    PathIndex,
+    RequestGovernor,
+    RangedDownload,
+    UploadSessions,
+    UnknownParent,
+)
+
+
+def test_upload_sessions(tmp_path):
+    sessions_file = str(tmp_path / "uploads.pickle")
+    sessions = UploadSessions.load(sessions_file)
+
+    sessions.put("a", ("id", 10, 100), "https://uri/a")
+    sessions.put("b", ("id", 10, 100), "https://uri/b")
+    sessions.discard("b")
+
+    # Sessions survive a restart, but only for the same content
+    sessions = UploadSessions.load(sessions_file)
+    assert len(sessions) == 1
+    assert sessions.get("a", ("id", 10, 100)) == "https://uri/a"
+    assert sessions.get("a", ("id", 20, 100)) is None
+    assert sessions.get("a", ("id", 10, 100)) is None
+
+
+def test_download_stream():
+    chunks = [bytes([i]) * 1000 for i in range(10)]
+
+    def fetch(buffer):
+        for chunk in chunks:
+            buffer.write(chunk)
+
+    stream = DownloadStream(fetch).start()
+    # Reads are short at chunk boundaries, like with pipes
+    assert stream.read(1500) == chunks[0]
+    assert stream.read(500) == chunks[1][:500]
+    assert stream.read() == b"".join(chunks)[1500:]
+    assert stream.read(10) == b""
+
+
+def test_download_stream_abort():
+    aborted = Event()
+
+    def fetch(buffer):
+        try:
+            while True:
+                buffer.write(b"x" * 1000)
+        except IOError:
+            aborted.set()
+            raise
+
+    stream = DownloadStream(fetch).start()
+    assert stream.read(10) == b"x" * 10
+    stream.close()
+    assert aborted.wait(1)
+
+
+def test_download_stream_error():
+    def fetch(buffer):
+        buffer.write(b"x")
+        raise IOError("connection lost")
+
+    stream = DownloadStream(fetch).start()
+    with pytest.raises(IOError):
+        stream.read()
+
+
+def test_ranged_download(tmp_path):
+    content = os.urandom(10000)
+    md5 = hashlib.md5(content).hexdigest()
+
+    def fetch(buffer):
+        buffer.write(content)
+
+    def fetch_range(start, end):
+        return content[start : end + 1]
+
+    with open(tmp_path / "file", "wb") as fout:
+        download = RangedDownload(fetch, fetch_range, len(content), md5, 1024, 4)
+        assert download.write_to(fout) == md5
+    assert (tmp_path / "file").read_bytes() == content
+
+    # The content can be streamed too
+    download = RangedDownload(fetch, fetch_range, len(content), md5, 1024, 4)
+    assert download.read() == content
+
+    with open(tmp_path / "corrupt", "wb") as fout:
+        download = RangedDownload(fetch, fetch_range, len(content), "0" * 32, 1024, 4)
+        with pytest.raises(IOError):
+            download.write_to(fout)
+
+
+class MockResponse:
+    def __init__(self, status):
+        self.status = status
+
+
+class MockHttpError(Exception):
+    def __init__(self, status):
+        self.resp = MockResponse(status)
+
+
+class MockBatchRequest:
+    def __init__(self, drive, callback):
+        self._drive = drive
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id):
+        self._requests.append((request, request_id))
+
+    def execute(self):
+        self._drive.batches.append(len(self._requests))
+        if self._drive.down:
+            raise HttpError(httplib2.Response({"status": 500}), b"")
+        for request, request_id in self._requests:
+            status = self._drive.errors.pop(request.uri, None)
+            if status:
+                self._callback(request_id, None, MockHttpError(status))
+            else:
+                self._callback(request_id, request.uri, None)
+
+
+class MockDrive:
+    def __init__(self, errors, down=False):
+        self.errors = errors
+        self.down = down  # The batch endpoint fails as a whole
+        self.batches = []
+
+    def new_batch_http_request(self, callback):
+        return MockBatchRequest(self, callback)
+
+
+class MockRequest:
+    def __init__(self, uri):
+        self.uri = uri
+
+    def execute(self):
+        return self.uri
+
+
+def test_metadata_batch(monkeypatch):
+    monkeypatch.setattr("erwin.fs.drive.sleep", lambda _: None)
+    CONNECTED.set()
+
+    drive = MockDrive({"r1": 503, "r2": 404})
+    batch = MetadataBatch(drive)
+    responses = []
+    for i in range(150):
+        batch.add(MockRequest(f"r{i}"), responses.append)
+    batch.flush()
+
+    # Transient failures are retried with the next batch, the others are sent
+    # on their own
+    assert drive.batches == [100, 51]
+    assert sorted(responses) == sorted(f"r{i}" for i in range(150))
+    assert not batch
+
+    # Requests of batches that fail as a whole are sent on their own
+    drive = MockDrive({}, down=True)
+    batch = MetadataBatch(drive)
+    responses = []
+    for i in range(150):
+        batch.add(MockRequest(f"r{i}"), responses.append)
+    batch.flush()
+
+    assert drive.batches == [100, 50]
+    assert responses == [f"r{i}" for i in range(150)]
+    assert not batch
+
+
+def test_path_index():
+    file_map = {
+        "root": {"id": "root", "name": "My Drive"},
+        "a": {"id": "a", "name": "a", "parents": ["root"]},
+        "b": {"id": "b", "name": "b", "parents": ["a"]},
+        "f": {"id": "f", "name": "f", "parents": ["b"]},
+    }
+    index = PathIndex(file_map)
+
+    assert index.path(file_map["f"]) == "My Drive/a/b/f"
+    assert index.id("My Drive/a/b") == "b"
+    assert len(index) == 4
+
+    # Moving a folder rewrites the paths of its subtree
+    file_map["b"] = {"id": "b", "name": "c", "parents": ["root"]}
+    assert index.path(file_map["b"]) == "My Drive/c"
+    assert index.id("My Drive/c/f") == "f"
+    assert index.id("My Drive/a/b/f") is None
+    assert index.path(file_map["f"]) == "My Drive/c/f"
+
+    with pytest.raises(UnknownParent):
+        index.path({"id": "g", "name": "g", "parents": ["unknown"]})
+    assert len(index) == 4
+
+    # Discarding a folder discards its subtree, whose paths are resolved anew
+    # once the folder is back
+    index.discard("b")
+    assert len(index) == 2
+    assert index.id("My Drive/c") is None and index.id("My Drive/c/f") is None
+
+    file_map["b"] = {"id": "b", "name": "d", "parents": ["a"]}
+    assert index.path(file_map["f"]) == "My Drive/a/d/f"
+    assert index.id("My Drive/a/d/f") == "f"
+    assert index.id("My Drive/c/f") is None
+    assert len(index) == 4
+
+
+def test_order_changes():
+    def change(file_id, *parents):
+        return {"fileId": file_id, "file": {"id": file_id, "parents": list(parents)}}
+
+    changes = [
+        change("f", "b"),
+        change("b", "a"),
+        change("x", "root"),
+        change("a", "root"),
+        change("b", "a", "root"),
+    ]
+
+    ordered = _order_changes(changes)
+    assert [c["fileId"] for c in ordered] == ["x", "a", "b", "f"]
+    assert ordered[2]["file"]["parents"] == ["a", "root"]
+
+    # Cycles are kept rather than dropped
+    assert len(_order_changes([change("a", "b"), change("b", "a")])) == 2
+
+
+def test_snapshot_compact():
+    df = {
+        "id": "f",
+        "name": "f.txt",
+        "parents": ["a"],
+        "mimeType": "text/plain",
+        "md5Checksum": "d41d8cd98f00b204e9800998ecf8427e",
+        "modifiedTime": "2020-01-01T00:00:00.000Z",
+        "size": "0",
+        "trashed": False,
+    }
+    folder = {"id": "a", "name": "a", "mimeType": GoogleDriveFS.FOLDER_MIMETYPE}
+
+    assert _expand("f", _compact(df)) == {k: v for k, v in df.items() if k != "trashed"}
+    assert _expand("a", _compact(folder)) == folder
+
+
+class MockHttp:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        status, content = response
+        return MockResponse(status), content
+
+
+def test_request_governor(monkeypatch):
+    monkeypatch.setattr("erwin.fs.drive.sleep", lambda _: None)
+
+    rate_limited = b'{"error": {"errors": [{"reason": "userRateLimitExceeded"}]}}'
+    forbidden = b'{"error": {"errors": [{"reason": "insufficientPermissions"}]}}'
+    http = MockHttp((429, b""), (403, rate_limited), (503, b""), (200, b"ok"))
+
+    governor = RequestGovernor(rate=1000, burst=1000, retries=3)
+    resp, content = governor.request(http, "uri")
+    assert (resp.status, content) == (200, b"ok")
+
+    # Other errors are returned to the caller straight away
+    http = MockHttp((403, forbidden))
+    assert governor.request(http, "uri")[0].status == 403
+
+    metrics = governor.metrics
+    assert metrics["requests"] == 5
+    assert metrics["throttled"] == 2
+    assert metrics["retries"] == 3
+    assert metrics["failures"] == 0
+
+    # Dropped connections are retried too, up to the limit
+    http = MockHttp(ConnectionResetError(), (200, b"ok"))
+    assert governor.request(http, "uri")[1] == b"ok"
+
+    http = MockHttp(*[ConnectionResetError()] * 4)
+    with pytest.raises(ConnectionResetError):
+        governor.request(http, "uri")
+    assert governor.metrics["failures"] == 1
+
+    # Bodies sent as bytes, like the chunks of resumable uploads, are sent
+    # again, whereas streamed ones are not
+    http = MockHttp((503, b""), (200, b"ok"))
+    assert governor.request(http, "uri", "PUT", body=b"chunk")[1] == b"ok"
+
+    http = MockHttp((503, b""), (200, b"ok"))
+    resp, _ = governor.request(http, "uri", "PUT", body=io.BytesIO(b"chunk"))
+    assert resp.status == 503
+
+
+def test_http_pool():
+    created = []
+
+    class Http:
+        def __init__(self):
+            created.append(self)
+
+        def request(self, uri, method="GET"):
+            return self, uri
+
+    pool = HttpPool(size=2, factory=Http)
+
+    # Idle Http objects are reused
+    assert pool.request("a")[0] is pool.request("b")[0]
+    assert len(pool) == 1
+
+    # Concurrent requests get an Http object each, up to the size of the pool
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(pool.request, range(100)))
+    assert len(pool) == len(created) <= 2
+
+
+def test_to_drive_time():
+    assert (
+        _to_drive_time(datetime(2020, 1, 1, 12, 0, 0, 123456))
+        == "2020-01-01T12:00:00.123Z"
+    )
+    assert (
+        _to_drive_time(datetime(2020, 1, 1, 12, 0, 59, 999900))
+        == "2020-01-01T12:01:00.000Z"
+    )
+
+
+class MockUploadRequest:
+    def __init__(self, status, headers=None, content=b""):
+        self.resumable = SimpleNamespace(size=lambda: 1024)
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self.sent = []
+
+        response = httplib2.Response(dict(headers or {}, status=status))
+
+        def request(uri, method, headers):
+            self.sent.append((uri, method, headers))
+            return response, content
+
+        self.http = SimpleNamespace(request=request)
+
+
+def test_upload_status():
+    request = MockUploadRequest(308, {"range": "bytes=0-511"})
+    assert GoogleDriveFS._upload_status(None, request, "uri") is None
+    assert request.sent == [
+        ("uri", "PUT", {"Content-Length": "0", "Content-Range": "bytes */1024"})
+    ]
+    assert request.resumable_uri == "uri"
+    assert request.resumable_progress == 512
+
+    # Nothing received yet
+    request = MockUploadRequest(308)
+    assert GoogleDriveFS._upload_status(None, request, "uri") is None
+    assert request.resumable_progress == 0
+
+    # The upload is complete already
+    request = MockUploadRequest(200, content=b'{"id": "file"}')
+    assert GoogleDriveFS._upload_status(None, request, "uri") == {"id": "file"}
+
+    # The session has expired
+    with pytest.raises(HttpError):
+        GoogleDriveFS._upload_status(None, MockUploadRequest(404), "uri")
+
+
+class MockFiles:
+    def __init__(self, dfs):
+        self.dfs = {df["id"]: df for df in dfs}
+        self.calls = []
+
+    def update(self, fileId, body, fields=None, addParents=None, removeParents=None):
+        self.calls.append(("update", fileId))
+        df = self.dfs[fileId]
+        df.update(body)
+        if addParents:
+            df["parents"] = [addParents]
+        return MockRequest(dict(df))
+
+    def copy(self, fileId, body, fields=None):
+        self.calls.append(("copy", fileId))
+        df = dict(self.dfs[fileId], **body, id=f"copy-{fileId}")
+        self.dfs[df["id"]] = df
+        return MockRequest(dict(df))
+
+
+def drive_fs():
+    CONNECTED.set()
+
+    mdate = _to_drive_time(datetime(2020, 1, 1))
+    dfs = {
+        "f": {"id": "f", "name": "f", "mimeType": GoogleDriveFS.FOLDER_MIMETYPE},
+        "g": {"id": "g", "name": "g", "mimeType": GoogleDriveFS.FOLDER_MIMETYPE},
+        "f/a": {
+            "id": "a",
+            "name": "a",
+            "md5Checksum": "m",
+            "modifiedTime": mdate,
+            "parents": ["f"],
+        },
+    }
+    files = MockFiles(dfs.values())
+
+    fs = GoogleDriveFS.__new__(GoogleDriveFS)
+    fs._drive = SimpleNamespace(files=lambda: files)
+    fs._local = local()
+    fs._trashed = OrderedDict()
+    fs._state = GoogleDriveFSState()
+    for path, df in dfs.items():
+        fs._state.add(fs._to_file(df), path)
+
+    return fs, files
+
+
+def test_drive_reuse_restore():
+    fs, files = drive_fs()
+    file = fs.search("f/a")
+
+    fs.remove("f/a")
+    assert fs.search("f/a") is None
+    assert files.dfs["a"]["trashed"]
+
+    # The trashed file is restored to the new path
+    assert fs.reuse(file, "g/b")
+    assert files.calls == [("update", "a"), ("update", "a")]
+    assert not files.dfs["a"]["trashed"]
+    assert fs.search("g/b")._id == "a"
+    assert fs.search("g/b").parents == ["g"]
+
+    # Only once
+    assert fs.reuse(file, "g/c")
+    assert files.calls[-1] == ("copy", "a")
+
+
+def test_drive_reuse_copy():
+    fs, files = drive_fs()
+    file = fs.search("f/a")
+
+    assert fs.reuse(file, "g/b")
+    assert files.calls == [("copy", "a")]
+    assert fs.search("g/b")._id == "copy-a"
+    assert fs.search("g/b").parents == ["g"]
+    assert fs.search("f/a")._id == "a"
+
+
+def test_drive_reuse_upload():
+    fs, files = drive_fs()
+    file = fs.search("f/a")
+    other = fs._to_file(dict(files.dfs["a"], md5Checksum="n"))
+
+    # Files are uploaded when no content matches or when they would overwrite
+    # an existing one
+    assert not fs.reuse(other, "g/b")
+    assert not fs.reuse(file, "f/a")
+    assert not files.calls
+    assert fs.search("g/b") is None
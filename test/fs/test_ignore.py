@@ -0,0 +1,57 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from erwin.fs.ignore import IgnoreRules
+
+
+def test_ignore_rules():
+    rules = IgnoreRules(
+        [
+            "# Comment",
+            "node_modules/",
+            "*.pyc",
+            "/build",
+            "docs/**/*.tmp",
+            "!keep.pyc",
+            "cache/",
+            "!cache/",
+        ]
+    )
+
+    assert rules.match("node_modules", is_dir=True)
+    assert not rules.match("node_modules", is_dir=False)
+    assert rules.match("a/node_modules/b/c.js")
+
+    assert rules.match("a/b.pyc")
+    assert not rules.match("a/keep.pyc")
+
+    assert rules.match("build/out.o")
+    assert not rules.match("src/build/out.o")
+
+    assert rules.match("docs/x.tmp")
+    assert rules.match("docs/a/b/x.tmp")
+    assert not rules.match("x.tmp")
+
+    assert not rules.match("cache/data", is_dir=True)
+
+    assert not IgnoreRules()
+    assert not IgnoreRules().match("anything")
@@ -0,0 +1,408 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from datetime import datetime
+import errno
+import hashlib
+import io
+import os
+from queue import Empty
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from googleapiclient.errors import HttpError
+import httplib2
+
+from erwin.fs import State
+from erwin.fs.drive import RangedDownload
+from erwin.fs.ignore import IgnoreRules
+from erwin.fs.local import (
+    _kernel_copy,
+    _walk,
+    LocalFS,
+    LocalFSEventHandler,
+    OperationRegistry,
+    TEMP_PREFIX,
+)
+
+from test.fs import MockFile, MockFileSystem
+
+WINDOW = 0.2
+
+
+@pytest.fixture
+def local_fs(tmp_path):
+    fs = LocalFS(str(tmp_path / "root"), event_window=WINDOW)
+    fs.state  # Start watching the file system
+    yield fs
+    fs._watchdog.stop()
+    fs._watchdog.join()
+
+
+def deltas(fs, quiet=WINDOW * 5):
+    # Collect the deltas queued by the event handler until none comes in for
+    # the given number of seconds.
+    collected = []
+    while True:
+        try:
+            collected.append(fs._queue.get(timeout=quiet))
+        except Empty:
+            return collected
+
+
+def md5(content):
+    return hashlib.md5(content).hexdigest()
+
+
+def test_coalesce_added_removed(local_fs):
+    path = os.path.join(local_fs.root, "a")
+    with open(path, "wb") as fo:
+        fo.write(b"a")
+    os.remove(path)
+
+    # Files created and removed within the window never make it to a delta
+    assert deltas(local_fs) == []
+    assert local_fs.state["a"] is None
+
+
+def test_coalesce_carried_over_move(local_fs):
+    src, dst = (os.path.join(local_fs.root, p) for p in ("a", "b"))
+    with open(src, "wb") as fo:
+        fo.write(b"content")
+    os.rename(src, dst)
+
+    # Pending events are carried over to the destination of a move
+    (delta,) = deltas(local_fs)
+    assert [(f.md5, p) for f, p in delta.added] == [(md5(b"content"), "b")]
+    assert not delta.moved and not delta.removed
+    assert local_fs.state["a"] is None
+
+
+def test_coalesce_move_keeps_unrelated_pending(local_fs):
+    known = os.path.join(local_fs.root, "known")
+    with open(known, "wb") as fo:
+        fo.write(b"known")
+    assert len(deltas(local_fs)) == 1
+
+    # A move of a known file while another one is being written does not
+    # flush the events of the latter, which is only hashed once complete.
+    written = os.path.join(local_fs.root, "written")
+    with open(written, "wb") as fo:
+        fo.write(b"first half")
+        fo.flush()
+        time.sleep(WINDOW / 4)
+        os.rename(known, known + "~")
+        time.sleep(WINDOW / 4)
+        fo.write(b" second half")
+
+    moved, added = deltas(local_fs)
+    assert moved.moved == [("known", "known~")] and not moved.added
+    assert [(f.md5, p) for f, p in added.added] == [
+        (md5(b"first half second half"), "written")
+    ]
+
+
+def test_coalesce_deadline_order(local_fs):
+    handler = LocalFSEventHandler(local_fs, window=60)
+
+    handler._push("a", handler.ADDED)
+    handler._push("b", handler.ADDED)
+    handler._push("c", handler.ADDED)
+    handler._push("a", handler.ADDED)
+
+    # Pending events are ordered by deadline and none is due yet
+    assert list(handler._pending) == ["b", "c", "a"]
+    assert handler._pop_pending() == []
+
+    # The addition of an unknown file followed by its removal cancel out
+    handler._push("c", handler.REMOVED)
+    assert handler._pop_pending(flush_all=True) == [
+        ("b", handler.ADDED),
+        ("a", handler.ADDED),
+    ]
+
+
+def test_write(local_fs):
+    state = local_fs.state
+    added = []
+    add = state.add
+    state.add = lambda file, path: added.append(path) or add(file, path)
+
+    mdate = datetime(2020, 1, 1, 12, 0, 0, 123000)
+    local_fs.write(io.BytesIO(b"content"), "a", mdate)
+
+    # The file is in place and in the state straight away
+    file = state["a"]
+    assert file.md5 == md5(b"content") and file.modified_date == mdate
+    with open(os.path.join(local_fs.root, "a"), "rb") as fi:
+        assert fi.read() == b"content"
+
+    # The events caused by the write are echoes and the temporary file never
+    # shows up
+    assert deltas(local_fs) == []
+    assert added == ["a"]
+    assert not [p for p, _ in state if TEMP_PREFIX in p]
+    assert os.listdir(local_fs.root) == ["a"]
+
+
+def test_operation_registry():
+    ops = OperationRegistry(ttl=WINDOW)
+    ops.register(LocalFSEventHandler.ADDED, "a")
+    ops.register(LocalFSEventHandler.MOVED, "b", "c")
+
+    # Events on the paths of the operations, and within them, are echoes
+    assert ops.is_echo(LocalFSEventHandler.ADDED, "a")
+    assert ops.is_echo(LocalFSEventHandler.MOVED, "b/d", "c/d")
+    assert not ops.is_echo(LocalFSEventHandler.MOVED, "b/d", "e/d")
+    assert not ops.is_echo(LocalFSEventHandler.REMOVED, "a")
+    assert not ops.is_echo(LocalFSEventHandler.ADDED, "ab")
+
+    # Real events after the operations have expired are not
+    time.sleep(WINDOW * 1.5)
+    assert not ops.is_echo(LocalFSEventHandler.ADDED, "a")
+    assert not ops.is_echo(LocalFSEventHandler.MOVED, "b/d", "c/d")
+
+
+def test_echo_expiry(local_fs):
+    local_fs._ops = OperationRegistry(ttl=WINDOW * 2)
+    local_fs.write(io.BytesIO(b"content"), "a", datetime(2020, 1, 1))
+    assert deltas(local_fs) == []
+
+    # A real change after the echo has expired is picked up
+    time.sleep(WINDOW * 2)
+    with open(os.path.join(local_fs.root, "a"), "wb") as fo:
+        fo.write(b"changed")
+
+    (delta,) = deltas(local_fs)
+    assert [(f.md5, p) for f, p in delta.added] == [(md5(b"changed"), "a")]
+
+
+def unsupported(name, calls, code):
+    def syscall(*args):
+        calls.append(name)
+        raise OSError(code, os.strerror(code))
+
+    return syscall
+
+
+def recorded(name, calls, f):
+    def syscall(*args):
+        calls.append(name)
+        return f(*args)
+
+    return syscall
+
+
+@pytest.mark.parametrize(
+    "failing,expected",
+    [
+        ([], ["copy_file_range"]),
+        (["copy_file_range"], ["copy_file_range", "sendfile"]),
+        (["copy_file_range", "sendfile"], ["copy_file_range", "sendfile"]),
+    ],
+)
+def test_kernel_copy_fallback(tmp_path, monkeypatch, failing, expected):
+    content = os.urandom(1 << 16)
+    (tmp_path / "src").write_bytes(content)
+
+    # Reflinks are never available here, and the other mechanisms are made to
+    # fail as on file systems that do not support them.
+    calls = []
+    monkeypatch.setattr(
+        "erwin.fs.local.fcntl",
+        SimpleNamespace(ioctl=unsupported("ioctl", calls, errno.EOPNOTSUPP)),
+    )
+    for name, code in [("copy_file_range", errno.EXDEV), ("sendfile", errno.EINVAL)]:
+        if not hasattr(os, name):
+            pytest.skip(f"os.{name} not available")
+        syscall = (
+            unsupported(name, calls, code)
+            if name in failing
+            else recorded(name, calls, getattr(os, name))
+        )
+        monkeypatch.setattr(os, name, syscall)
+
+    with open(tmp_path / "src", "rb") as fin, open(tmp_path / "dst", "wb") as fout:
+        copied = _kernel_copy(fin, fout)
+
+    assert list(dict.fromkeys(calls)) == ["ioctl"] + expected
+    if len(failing) < 2:
+        assert copied
+        assert (tmp_path / "dst").read_bytes() == content
+    else:
+        assert not copied
+        assert (tmp_path / "dst").read_bytes() == b""
+
+
+def make_tree(root):
+    for path, content in [
+        ("a", b"a"),
+        ("d/b", b"b"),
+        ("d/e/c", b"c"),
+        ("build/f", b"f"),
+        ("d/build/g", b"g"),
+        ("h.log", b"h"),
+    ]:
+        abs_path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
+        with open(abs_path, "wb") as fo:
+            fo.write(content)
+
+
+def test_walk(tmp_path):
+    make_tree(str(tmp_path))
+
+    def rel(path):
+        return os.path.relpath(path, str(tmp_path))
+
+    walked = {rel(p): stat for p, stat in _walk(str(tmp_path))}
+    assert set(walked) == {
+        "a",
+        "d",
+        "d/b",
+        "d/e",
+        "d/e/c",
+        "build",
+        "build/f",
+        "d/build",
+        "d/build/g",
+        "h.log",
+    }
+    assert walked["d/e/c"].st_size == 1
+
+    # Folders are yielded before their content
+    order = [rel(p) for p, _ in _walk(str(tmp_path))]
+    assert order.index("d") < order.index("d/e") < order.index("d/e/c")
+
+    # Ignored folders are pruned together with their content
+    ignore = IgnoreRules(["build/", "*.log"])
+    walked = [
+        rel(p) for p, _ in _walk(str(tmp_path), lambda p, d: ignore.match(rel(p), d))
+    ]
+    assert sorted(walked) == ["a", "d", "d/b", "d/e", "d/e/c"]
+
+
+@pytest.mark.parametrize("processes", [False, True])
+def test_list_parallel(tmp_path, processes):
+    root = str(tmp_path / "root")
+    make_tree(root)
+
+    def listing(**kwargs):
+        fs = LocalFS(root, ignore=IgnoreRules(["build/"]), **kwargs)
+        return {p: (f.md5, f.modified_date) for p, f in fs._list()}
+
+    serial = listing(hash_workers=1)
+    assert serial["d/e/c"][0] == md5(b"c")
+    assert "d/build/g" not in serial
+
+    # Hashing in parallel gives the same result as hashing serially
+    assert listing(hash_workers=8, hash_processes=processes) == serial
+
+
+class DroppedStream(io.RawIOBase):
+    # A download whose connection drops after the first chunk.
+    def __init__(self, chunk):
+        self._chunks = [chunk]
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._chunks:
+            raise ConnectionResetError("Connection dropped")
+        chunk = self._chunks.pop()
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
+
+class MockSourceFileSystem(MockFileSystem):
+    def __init__(self, contents):
+        super().__init__("/")
+        self._contents = contents
+        for path, content in contents.items():
+            file = MockFile(md5(content))
+            file.modified_date = datetime(2020, 1, 1)
+            self.state[path] = file
+
+    def read(self, path):
+        if path == "failing":
+            return DroppedStream(self._contents[path][:4])
+        return io.BytesIO(self._contents[path])
+
+
+def test_delta_apply_failed_download(local_fs):
+    source = MockSourceFileSystem({"failing": b"failing content", "ok": b"ok"})
+    source_state, dest_state = State(), State()
+
+    delta = source.state - source_state
+    delta.apply((source, source_state), (local_fs, dest_state), workers=2)
+
+    # The failed download is left out of both states, and of the local copy,
+    # whereas the other files are transferred
+    assert source_state["failing"] is None and dest_state["failing"] is None
+    assert source_state["ok"] is not None and dest_state["ok"] is not None
+    assert os.listdir(local_fs.root) == ["ok"]
+
+
+def ranged_download(content, checksum=None, fail_at=None):
+    def fetch(buffer):
+        buffer.write(content)
+
+    def fetch_range(start, end):
+        if fail_at is not None and start >= fail_at:
+            raise HttpError(httplib2.Response({"status": 404}), b"")
+        return content[start : end + 1]
+
+    checksum = checksum or md5(content)
+    return RangedDownload(fetch, fetch_range, len(content), checksum, 1024, 4)
+
+
+@pytest.mark.parametrize(
+    "download,error",
+    [
+        (lambda c: ranged_download(c, fail_at=0), HttpError),
+        (lambda c: ranged_download(c, fail_at=4096), HttpError),
+        (lambda c: ranged_download(c, checksum="0" * 32), IOError),
+    ],
+)
+def test_write_failed_ranged_download(local_fs, download, error):
+    content = os.urandom(10000)
+
+    # Failed ranged downloads leave neither the file nor its temporary file
+    # behind
+    with pytest.raises(error):
+        local_fs.write(download(content), "a", datetime(2020, 1, 1))
+    assert local_fs.state["a"] is None
+    assert os.listdir(local_fs.root) == []
+
+    # Through a delta, the file is left out of the states
+    source = MockSourceFileSystem({"a": content})
+    source.read = lambda path: download(content)
+    source_state, dest_state = State(), State()
+    delta = source.state - source_state
+    delta.apply((source, source_state), (local_fs, dest_state))
+
+    assert source_state["a"] is None and dest_state["a"] is None
+    assert os.listdir(local_fs.root) == []
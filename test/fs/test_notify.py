@@ -0,0 +1,60 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from http.client import HTTPConnection
+from threading import Event
+
+from erwin.fs.notify import PollScheduler, WebhookListener
+
+
+def test_poll_scheduler():
+    scheduler = PollScheduler(1, 4, 2)
+
+    scheduler.idle()
+    scheduler.idle()
+    scheduler.idle()
+    assert scheduler.interval == 4
+
+    scheduler.activity()
+    assert scheduler.interval == 1
+
+    scheduler.trigger()
+    assert scheduler.wait()
+
+
+def test_webhook_listener():
+    notified = Event()
+    listener = WebhookListener(lambda headers: notified.set(), "secret").start()
+
+    def post(token):
+        connection = HTTPConnection("127.0.0.1", listener.port)
+        connection.request("POST", "/", headers={"X-Goog-Channel-Token": token})
+        return connection.getresponse().status
+
+    try:
+        assert post("wrong") == 403
+        assert not notified.is_set()
+
+        assert post("secret") == 200
+        assert notified.wait(1)
+    finally:
+        listener.stop()
@@ -20,7 +20,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+
+import pytest
+
 from erwin.fs import State
+from erwin.fs.ignore import IgnoreRules
 
 from test.fs import MockDir, MockFile
 
@@ -49,3 +55,86 @@ def test_state():
     assert set(delta.added) == {(b2, "b"), (c3, "c")}
     assert set(delta.moved) == {("b", "a")}
     assert set(delta.removed) == {"d", "z"}
+
+
+def test_state_ignore():
+    s, t = State(), State()
+    s.ignore = IgnoreRules(["*.log", "build/"])
+
+    s.add(MockFile(1), "a")
+    s.add(MockFile(2), "b.log")
+    s.add(MockFile(3), "c")
+
+    t.add(MockFile(1), "build/a")
+    t.add(MockFile(3), "d")
+    t.add(MockDir(4), "build")
+
+    delta = s - t
+
+    assert set(delta.added) == {(s["a"], "a")}
+    assert set(delta.moved) == {("d", "c")}
+    assert set(delta.removed) == set()
+
+
+def test_state_wait_for():
+    s = State()
+    a1 = MockFile(1)
+
+    with pytest.raises(TimeoutError):
+        s.wait_for("a", bool, timeout=0.01)
+
+    waiter = ThreadPoolExecutor(max_workers=1).submit(s.wait_for, "a", bool, 5)
+    s.add(a1, "a")
+    assert waiter.result() is a1
+
+    waiter = ThreadPoolExecutor(max_workers=1).submit(
+        s.wait_for, "a", lambda f: not f, 5
+    )
+    s.move("a", "b")
+    assert waiter.result() is None
+
+    # Each state has a lock of its own and notifies its own waiters, also after
+    # a round trip through pickle
+    t = pickle.loads(pickle.dumps(s))
+    assert t._lock is not s._lock and t._changed is not s._changed
+    waiter = ThreadPoolExecutor(max_workers=1).submit(t.wait_for, "c", bool, 5)
+    t.add(a1, "c")
+    assert waiter.result() is a1
+
+
+def test_state_find():
+    s = State()
+    a1, b1, d2 = MockFile(1), MockFile(1), MockFile(2)
+
+    s.add(a1, "a")
+    s.add(b1, "b")
+    s.add(MockDir(3), "c")
+    s.add(d2, "d")
+
+    assert s.find(1) in {("a", a1), ("b", b1)}
+    assert s.find(2) == ("d", d2)
+    assert s.find(3) is None
+
+    s.remove("a")
+    s.move("b", "e")
+    assert s.find(1) == ("e", b1)
+
+    s.remove("e")
+    assert s.find(1) is None
+
+    # States saved before the content index are indexed on load
+    del s._data["by_md5"]
+    t = pickle.loads(pickle.dumps(s))
+    assert t.find(2)[0] == "d"
+
+
+def test_state_sub_concurrent():
+    s, t = State(), State()
+    for i in range(100):
+        s.add(MockFile(i), f"s{i}")
+        t.add(MockFile(i), f"t{i}")
+
+    # Comparisons in opposite directions do not deadlock
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        deltas = list(pool.map(lambda x: x[0] - x[1], [(s, t), (t, s)] * 50))
+    assert all(len(d.moved) == 100 for d in deltas)
@@ -0,0 +1,66 @@
+# This file is part of "erwin" which is released under GPL.
+#
+# See file LICENCE or go to http://www.gnu.org/licenses/ for full license
+# details.
+#
+# Erwin is a cloud storage synchronisation service.
+#
+# Copyright (c) 2020 Gabriele N. Tornetta <phoenix1987@gmail.com>.
+# All rights reserved.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from threading import Thread
+
+from erwin.flow import PathLock, TokenBucket
+
+
+def test_path_lock():
+    lock = PathLock()
+
+    def try_acquire(*paths):
+        acquired = []
+
+        def target():
+            acquired.append(lock.acquire(*paths))
+
+        thread = Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(0.1)
+
+        return acquired
+
+    with lock.hold("a/b"):
+        # Re-entrant
+        with lock.hold("a"):
+            pass
+
+        assert try_acquire("c")
+        assert try_acquire("a/bc")
+        assert not try_acquire("a/b")
+        assert not try_acquire("a")
+        assert not try_acquire("a/b/c")
+        assert not try_acquire("")
+
+
+def test_token_bucket(monkeypatch):
+    slept = []
+    monkeypatch.setattr("erwin.flow.sleep", slept.append)
+
+    bucket = TokenBucket(rate=10, capacity=2)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+
+    # An empty bucket makes callers wait for the tokens they reserve
+    assert bucket.acquire() > 0
+    assert bucket.acquire(5) > slept[0]